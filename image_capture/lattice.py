@@ -0,0 +1,249 @@
+import math
+import numpy as np
+
+from constants import *
+
+"""Locates the whole well lattice of a tray in one shot.
+
+Rather than finding the origin well and walking from well to well, the
+known layout of the tray (from constants.py) is rendered as a template
+of discs and cross-correlated with the thresholded image, so every well
+centre is placed at once and one bad well can't drag its neighbours off.
+
+The correlation is normalized (NCC): the template is zero-mean, and the
+image's own mean and energy under the template at each offset come from
+integral images, so the score is 1 for a perfect match at any scale and
+scales can be compared directly. The correlation itself is done by FFT
+on a padded image, which also lets the tray hang partly off the edge.
+
+Lattice co-ordinates are (row, col) in mm relative to the centre of the
+upper left big well, with big wells first, row by row, then the small
+wells row by row without the missing outer corners, in the same order as
+QuantiTray.lstBigWells and lstSmallWells.
+"""
+
+def wellLattice(nBigWellRows, nBigWellCols, nSmallWellRows, nSmallWellCols):
+    # (row, col) mm positions of the big and small wells, each as an (N, 2) array
+    lstBig = [(nI*fBigWellSpacing_mm, nJ*fBigWellSpacing_mm) for nI in range(nBigWellRows) for nJ in range(nBigWellCols)]
+    lstSmall = [(fFirstSmallWellRow_mm+nI*fSmallWellSpacing_mm, fFirstSmallWellColumn_mm+nJ*fSmallWellSpacing_mm)
+                for nI in range(nSmallWellRows) for nJ in range(nSmallWellCols)
+                if not (nJ == 0 and (nI == 0 or nI == nSmallWellRows-1))] # skip outer corner small wells
+    return np.array(lstBig, dtype=float).reshape([-1, 2]), np.array(lstSmall, dtype=float).reshape([-1, 2])
+
+def renderTemplate(arrCentres, arrRadii):
+    """
+    Discs of arrRadii pixels at arrCentres, an (N, 2) array of pixel positions relative to
+    the origin well, on a zero-mean float32 template just big enough to hold them. Returns
+    the template and the position of the origin well on it.
+    """
+    arrTopLeft = np.floor((arrCentres-arrRadii[:, None]).min(axis=0)).astype(int)-1
+    arrBottomRight = np.ceil((arrCentres+arrRadii[:, None]).max(axis=0)).astype(int)+2
+    arrTemplate = np.zeros(arrBottomRight-arrTopLeft, dtype=np.float32)
+    arrOrigin = -arrTopLeft
+    for (fRow, fCol), fRadius in zip((arrCentres+arrOrigin).tolist(), arrRadii.tolist()):
+        nTop, nLeft = max(int(fRow-fRadius), 0), max(int(fCol-fRadius), 0)
+        arrRow, arrCol = np.ogrid[nTop:int(fRow+fRadius)+2, nLeft:int(fCol+fRadius)+2]
+        arrTemplate[nTop:nTop+arrRow.shape[0], nLeft:nLeft+arrCol.shape[1]] += (arrRow-fRow)**2+(arrCol-fCol)**2 < fRadius**2
+    arrTemplate -= arrTemplate.mean()
+    return arrTemplate, arrOrigin
+
+def integralImage(arrImage):
+    # cumulative sums with a leading row and column of zeros, so any box sum is four lookups
+    arrIntegral = np.zeros([arrImage.shape[0]+1, arrImage.shape[1]+1])
+    np.cumsum(np.cumsum(arrImage, axis=0), axis=1, out=arrIntegral[1:, 1:])
+    return arrIntegral
+
+def fastLength(nLength):
+    # the smallest length of at least nLength with no prime factors over 5, which the FFT does quickly
+    nBest = 2**int(math.ceil(math.log2(nLength)))
+    nPower5 = 1
+    while nPower5 < nBest:
+        nPower35 = nPower5
+        while nPower35 < nBest:
+            nCandidate = nPower35
+            while nCandidate < nLength:
+                nCandidate *= 2
+            nBest = min(nBest, nCandidate)
+            nPower35 *= 3
+        nPower5 *= 5
+    return nBest
+
+class TemplateMatcher:
+    """
+    Normalized cross-correlation of zero-mean templates up to tupMaxTemplate in size with one
+    image, at every offset that leaves at least half the template on the image. The image is
+    padded by half the largest template on each side (then out to sizes the FFT likes), and
+    its spectrum and integral images are computed once for all the templates matched.
+    """
+    def __init__(self, arrImage, tupMaxTemplate):
+        self.nPadRows, self.nPadCols = tupMaxTemplate[0]//2, tupMaxTemplate[1]//2
+        self.nImageRows, self.nImageCols = arrImage.shape
+        self.tupShape = (fastLength(self.nImageRows+2*self.nPadRows+1), fastLength(self.nImageCols+2*self.nPadCols+1))
+        arrPadded = np.zeros(self.tupShape)
+        arrPadded[self.nPadRows:self.nPadRows+self.nImageRows, self.nPadCols:self.nPadCols+self.nImageCols] = arrImage
+        self.arrSpectrum = np.fft.rfft2(arrPadded)
+        self.lstIntegrals = [integralImage(arrPadded), integralImage(arrPadded**2)]
+
+    def match(self, arrTemplate):
+        # returns the best (row, col) offset of the template's top left corner in the image,
+        # which may be negative, and its score
+        nTemplateRows, nTemplateCols = arrTemplate.shape
+        # offsets from half a template off the top left of the image to half off the bottom right
+        nFirstRow, nFirstCol = self.nPadRows-nTemplateRows//2, self.nPadCols-nTemplateCols//2
+        nRows = self.nImageRows+2*(nTemplateRows//2)-nTemplateRows+1
+        nCols = self.nImageCols+2*(nTemplateCols//2)-nTemplateCols+1
+
+        # circular correlation, but offsets that fit inside the padded image never wrap
+        arrCorrelation = np.fft.irfft2(self.arrSpectrum*np.conj(np.fft.rfft2(arrTemplate, self.tupShape)), self.tupShape)
+        arrCorrelation = arrCorrelation[nFirstRow:nFirstRow+nRows, nFirstCol:nFirstCol+nCols]
+
+        # the image's variance under the template at each offset, from box sums
+        nArea = arrTemplate.size
+        lstBoxSums = []
+        for arrIntegral in self.lstIntegrals:
+            arrIntegral = arrIntegral[nFirstRow:, nFirstCol:]
+            lstBoxSums.append(arrIntegral[nTemplateRows:nTemplateRows+nRows, nTemplateCols:nTemplateCols+nCols]
+                              -arrIntegral[:nRows, nTemplateCols:nTemplateCols+nCols]
+                              -arrIntegral[nTemplateRows:nTemplateRows+nRows, :nCols]+arrIntegral[:nRows, :nCols])
+        arrVariance = lstBoxSums[1]-lstBoxSums[0]**2/nArea
+        fTemplateNorm = float(np.sqrt(np.sum(arrTemplate.astype(float)**2)))
+        arrScore = np.zeros_like(arrCorrelation)
+        arrFlat = arrVariance > 1E-6*nArea # nothing to match against in empty windows
+        arrScore[arrFlat] = arrCorrelation[arrFlat]/(fTemplateNorm*np.sqrt(arrVariance[arrFlat]))
+
+        nRow, nCol = np.unravel_index(np.argmax(arrScore), arrScore.shape)
+        return int(nRow)+nFirstRow-self.nPadRows, int(nCol)+nFirstCol-self.nPadCols, float(arrScore[nRow, nCol])
+
+def locateLattice(arrMask, fScale, arrBig_mm, arrSmall_mm, lstScales=lstLatticeScales, nStep=nLatticeStep):
+    """
+    Finds the tray lattice in arrMask (well pixels non-zero) by template matching at each
+    of the scale factors lstScales times fScale (pixels per mm). The search runs on the
+    mask reduced by nStep in each direction. Returns the image position of the origin
+    well's centre, the best scale and its score.
+    """
+    nRows, nCols = arrMask.shape[0]//nStep*nStep, arrMask.shape[1]//nStep*nStep
+    arrSmall = arrMask[:nRows, :nCols].reshape([nRows//nStep, nStep, nCols//nStep, nStep]).mean(axis=(1, 3), dtype=np.float32)
+    arrCentres_mm = np.concatenate([arrBig_mm, arrSmall_mm])
+    arrRadii_mm = np.concatenate([np.full(len(arrBig_mm), fBigWellSize_mm/2), np.full(len(arrSmall_mm), fSmallWellSize_mm/2)])
+
+    lstTemplates = [renderTemplate(arrCentres_mm*fScale*fFactor/nStep, arrRadii_mm*fScale*fFactor/nStep) for fFactor in lstScales]
+    pMatcher = TemplateMatcher(arrSmall, np.max([arrTemplate.shape for arrTemplate, arrOrigin in lstTemplates], axis=0))
+    tupBest = None
+    for fFactor, (arrTemplate, arrOrigin) in zip(lstScales, lstTemplates):
+        nRow, nCol, fScore = pMatcher.match(arrTemplate)
+        if tupBest is None or fScore > tupBest[3]:
+            tupBest = (nRow+int(arrOrigin[0]), nCol+int(arrOrigin[1]), fScale*fFactor, fScore)
+
+    nOriginRow, nOriginCol, fBestScale, fScore = tupBest
+    # back to full resolution, a reduced pixel is centred between the pixels it covers
+    return nOriginRow*nStep+(nStep-1)/2, nOriginCol*nStep+(nStep-1)/2, fBestScale, fScore
+
+def fitLattice(arrLattice_mm, arrCentres, arrUse=None, arrBlocks=None):
+    """
+    Least squares fit of a similarity (scale, rotation and offset) taking the lattice mm
+    positions to the (N, 2) well centres found, from the wells marked in arrUse. arrBlocks
+    numbers the blocks of wells (0 for big wells, 1 for small) that share the scale and
+    rotation but each get their own offset, since the small block is only placed against
+    the big one by approximate constants. A block with fewer than 3 wells to use is tied
+    to block 0. Wells more than fLatticeOutlierFactor median residuals of their block (and
+    at least fLatticeOutlierFloor pixels) off the fit are dropped and the fit repeated until
+    the inliers settle. Returns the model (fA, fB, row offsets, column offsets), with the
+    scale hypot(fA, fB) and an offset per block, and the inliers it was fitted to.
+    """
+    if arrUse is None or np.count_nonzero(arrUse) < 3: # too few to trust, so use everything
+        arrUse = np.ones(len(arrCentres), dtype=bool)
+    arrUse = np.asarray(arrUse, dtype=bool)
+    arrBlocks = np.zeros(len(arrCentres), dtype=int) if arrBlocks is None else np.asarray(arrBlocks, dtype=int)
+    nBlocks = int(arrBlocks.max())+1 if len(arrBlocks) else 1
+    arrFitBlocks = arrBlocks.copy()
+    for nBlock in range(1, nBlocks):
+        if np.count_nonzero(arrUse & (arrBlocks == nBlock)) < 3:
+            arrFitBlocks[arrBlocks == nBlock] = 0
+    lstFitBlocks = np.unique(arrFitBlocks).tolist()
+    arrInliers = arrUse.copy()
+    arrRow_mm, arrCol_mm = arrLattice_mm[:, 0], arrLattice_mm[:, 1]
+    # row = fA*row_mm - fB*col_mm + row offset of the block, col = fB*row_mm + fA*col_mm + column offset of the block
+    arrOffsets = np.eye(nBlocks)[arrFitBlocks]
+    arrZeros = np.zeros(arrOffsets.shape)
+    arrDesign = np.concatenate([np.column_stack([arrRow_mm, -arrCol_mm, arrOffsets, arrZeros]),
+                                np.column_stack([arrCol_mm, arrRow_mm, arrZeros, arrOffsets])])
+    arrTarget = np.concatenate([arrCentres[:, 0], arrCentres[:, 1]])
+    for nI in range(len(arrCentres)): # refit until the inliers settle, at most once per well
+        arrFitted = arrInliers # the wells this model is fitted to
+        arrEquations = np.concatenate([arrFitted, arrFitted])
+        arrModel = np.linalg.lstsq(arrDesign[arrEquations], arrTarget[arrEquations], rcond=None)[0]
+        arrResiduals = np.hypot(*(arrDesign@arrModel-arrTarget).reshape([2, -1]))
+        arrLimits = np.full(len(arrCentres), fLatticeOutlierFloor)
+        for nBlock in lstFitBlocks: # outliers are judged within each block, so no block is thrown out whole
+            arrBlock = arrFitBlocks == nBlock
+            arrLimits[arrBlock] = max(fLatticeOutlierFactor*float(np.median(arrResiduals[arrInliers & arrBlock])), fLatticeOutlierFloor)
+        arrNext = arrUse & (arrResiduals <= arrLimits)
+        if np.array_equal(arrNext, arrInliers) or min([np.count_nonzero(arrNext & (arrFitBlocks == nBlock)) for nBlock in lstFitBlocks]) < 3:
+            break
+        arrInliers = arrNext
+    for nBlock in range(1, nBlocks):
+        if nBlock not in lstFitBlocks: # tied blocks take the offset of block 0
+            arrModel[2+nBlock] = arrModel[2]
+            arrModel[2+nBlocks+nBlock] = arrModel[2+nBlocks]
+    return arrModel, arrFitted
+
+def placeLattice(arrModel, arrLattice_mm, arrBlocks=None):
+    # the (N, 2) image positions of the lattice under a model from fitLattice(), with the same blocks
+    nBlocks = (len(arrModel)-2)//2
+    arrBlocks = np.zeros(len(arrLattice_mm), dtype=int) if arrBlocks is None else np.asarray(arrBlocks, dtype=int)
+    fA, fB = arrModel[:2]
+    arrRowOffsets, arrColOffsets = arrModel[2:2+nBlocks], arrModel[2+nBlocks:]
+    return np.stack([fA*arrLattice_mm[:, 0]-fB*arrLattice_mm[:, 1]+arrRowOffsets[arrBlocks],
+                     fB*arrLattice_mm[:, 0]+fA*arrLattice_mm[:, 1]+arrColOffsets[arrBlocks]], axis=1)
+
+if __name__ == "__main__":
+    from time import time
+    
+    if True: # recover a known lattice from a noisy mask with wells missing, the origin well among them
+        pRandom = np.random.default_rng(0)
+        for bHasSmallWells, tupBig, tupSmall in [(True, (6, 8), (10, 5)), (False, (5, 10), (0, 0))]:
+            arrBig_mm, arrSmall_mm = wellLattice(*tupBig, *tupSmall)
+            fScale, fOriginRow, fOriginCol = 2.3, 157.4, (205.2 if bHasSmallWells else 96.7)
+            arrCentres_mm = np.concatenate([arrBig_mm, arrSmall_mm])
+            arrRadii_mm = np.concatenate([np.full(len(arrBig_mm), fBigWellSize_mm/2), np.full(len(arrSmall_mm), fSmallWellSize_mm/2)])
+            arrKeep = pRandom.random(len(arrCentres_mm)) > 0.15 # lose some wells
+            arrKeep[0] = False # including the origin
+            arrRow, arrCol = np.ogrid[:480, :640]
+            arrMask = pRandom.random((480, 640)) < 0.05 # speckle
+            for (fRow, fCol), fRadius in zip(arrCentres_mm[arrKeep]*fScale, arrRadii_mm[arrKeep]*fScale):
+                arrMask |= (arrRow-fOriginRow-fRow)**2+(arrCol-fOriginCol-fCol)**2 < fRadius**2
+            fStart = time()
+            fFoundRow, fFoundCol, fFoundScale, fScore = locateLattice(arrMask, fScale*1.04, arrBig_mm, arrSmall_mm)
+            fTime = time()-fStart
+            assert abs(fFoundRow-fOriginRow) < 3 and abs(fFoundCol-fOriginCol) < 3 and abs(fFoundScale/fScale-1) < 0.03
+            print("QT2000" if bHasSmallWells else "QT", "origin", (round(float(fFoundRow), 1), round(float(fFoundCol), 1)), "for", (fOriginRow, fOriginCol),
+                  "scale", round(fFoundScale, 3), "for", fScale, "score", round(fScore, 3), "time:", fTime)
+        fNoTrayScore = locateLattice(pRandom.random((480, 640)) < 0.05, 2.3, arrBig_mm, arrSmall_mm)[3] # speckle only
+        assert fNoTrayScore < fLatticeMinScore
+        print("No tray, score", round(fNoTrayScore, 3))
+
+    if True: # fit a rotated lattice through noisy centres with some wells badly off, and the small block off its constants
+        arrBig_mm, arrSmall_mm = wellLattice(6, 8, 10, 5)
+        arrLattice_mm = np.concatenate([arrBig_mm, arrSmall_mm])
+        arrBlocks = np.concatenate([np.zeros(len(arrBig_mm), dtype=int), np.ones(len(arrSmall_mm), dtype=int)])
+        arrTrue = np.array([2.25*math.cos(0.01), 2.25*math.sin(0.01), 160.0, 215.0])
+        for tupShift_mm in [(0.0, 0.0), (1.5, 0.0), (0.0, 2.5), (1.5, -2.0)]:
+            arrTrue_mm = arrLattice_mm+arrBlocks[:, None]*np.array(tupShift_mm) # where the small wells really are
+            arrTruePlaces = placeLattice(arrTrue, arrTrue_mm)
+            arrCentres = arrTruePlaces+pRandom.normal(0, 0.7, (len(arrLattice_mm), 2))
+            arrBad = pRandom.random(len(arrLattice_mm)) < 0.1
+            arrCentres[arrBad] += pRandom.normal(0, 15, (np.count_nonzero(arrBad), 2)) # wells found in the wrong place
+            nRepeats = 100
+            fStart = time()
+            for nI in range(nRepeats):
+                arrModel, arrInliers = fitLattice(arrLattice_mm, arrCentres, None, arrBlocks)
+            fTime = (time()-fStart)/nRepeats
+            arrErrors = np.abs(placeLattice(arrModel, arrLattice_mm, arrBlocks)-arrTruePlaces).max(axis=1)
+            arrTrueResiduals = np.hypot(*(arrCentres-arrTruePlaces).T)
+            assert arrErrors.max() < 1.0 and not np.any(arrInliers & arrBad & (arrTrueResiduals > 5))
+            assert not np.any(~arrInliers & (arrTrueResiduals < 1.5)) # good wells are kept whatever the shift
+            print("lattice fit, small block shifted", tupShift_mm, "mm,", np.count_nonzero(~arrInliers), "of", np.count_nonzero(arrBad),
+                  "bad wells rejected, worst placement error big/small", round(float(arrErrors[arrBlocks == 0].max()), 2),
+                  round(float(arrErrors[arrBlocks == 1].max()), 2), "pixels, scale", round(math.hypot(arrModel[0], arrModel[1]), 4), "for 2.25, time:", fTime)
+        arrModel, arrInliers = fitLattice(arrBig_mm, placeLattice(arrTrue, arrBig_mm)) # a QT tray is one block
+        assert len(arrModel) == 4 and np.abs(arrModel-arrTrue).max() < 1e-6 and arrInliers.all()
@@ -1,6 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 import math
 import numpy as np
 import os
+import threading
+
+from map_cache import MapCache
 
 """Applies the Tsai unwarping model to an image held as a numpy array.
 
@@ -42,22 +46,78 @@ k*Rd**3 + Rd - Ru = 0
 
 Under the circumstances found here this equation has two complex
 and one real root, which is always returned last. The real root is the
-one we want.
+one we want. It is found for every target pixel at once by sourceRsquared,
+in closed form for positive K and by Newton's method otherwise.
 
 """
 
 nColors = 3
 nDimensions = 2
 
-def distanceFunction(fTargetRsquared, fK):
-    # This is the "right" way to get the distorted distance from the undistorted
-    # value, but it is fantastically slow (~40 times slower than the simple lookup
-    # used here, taking an unwarping from < 0.5 s to ~20 seconds.). It is used
-    # go generate a lookup table during construction of the Unwarper, and this
-    # lookup table is used--without interpolation--during unwarping. The
-    # difference in the resulting unwarped images with and without interpolation
-    # is minimal.
-    return (np.roots([fK, 0, 1, -math.sqrt(fTargetRsquared)])[-1].real)**2
+nMapFormat = 3 # bump whenever the layout or contents of precomputed maps change
+nStripRows = 64 # target rows remapped at a time, bounding temporaries on big images
+nOutside = -1 # map value for target pixels with no source pixel
+
+def sourceRsquared(arrTargetRsquared, fK, fTolerance=1E-12, nMaxIterations=20):
+    """Vectorized inverse of the radial model: solves k*Rd**3 + Rd - Ru = 0
+    for every element of the array at once and returns Rd**2.
+
+    For K > 0 there is exactly one real root, given in closed form by Cardano's
+    formula, written with Vieta's substitution Rd = A - 1/(3*k*A) so the two
+    cube roots don't cancel. For K < 0 the cubic can have three real roots and
+    we want the one nearest Ru, so Newton's method is run from Rd = Ru. That
+    root only exists up to the fold of the cubic, Ru = 2/3*sqrt(-1/(3*k)), so
+    a radius beyond the fold, or Newton failing to converge, raises ValueError
+    rather than returning a wrong radius."""
+    arrTargetR = np.sqrt(arrTargetRsquared)
+    if fK > 0:
+        arrA = np.cbrt(arrTargetR/(2*fK) + np.sqrt(arrTargetRsquared/(4*fK**2) + 1/(27*fK**3)))
+        arrR = arrA - 1/(3*fK*arrA)
+    elif fK < 0:
+        fFold = 2/3*math.sqrt(-1/(3*fK))
+        if arrTargetR.size and np.max(arrTargetR) > fFold:
+            raise ValueError("radius "+str(np.max(arrTargetR))+" is beyond the fold at "+str(fFold)+" for K = "+str(fK))
+        arrR = np.array(arrTargetR, dtype=float)
+        for nI in range(nMaxIterations):
+            arrStep = (fK*arrR**3 + arrR - arrTargetR)/(3*fK*arrR**2 + 1)
+            arrR -= arrStep
+            if not arrStep.size or np.max(np.abs(arrStep)) < fTolerance:
+                break
+        else:
+            raise ValueError("Newton's method did not converge for K = "+str(fK))
+    else:
+        arrR = np.array(arrTargetR, dtype=float)
+    return arrR**2
+
+def mapKey(strKind, fK, nSourceWidth, nSourceHeight, nPadding):
+    # the key has to cover every input to the map, plus the layout version
+    return ("unwarp_"+strKind+"_v"+str(nMapFormat)+"_k"+repr(float(fK))
+                +"_"+str(nSourceWidth)+"x"+str(nSourceHeight)+"_p"+str(nPadding))
+
+def sourceOffsets(fK, nSourceHeight, nSourceWidth, nTargetHeight, nTargetWidth):
+    """Pull model for a whole target raster: returns the (row, col) arrays of
+    the exact (fractional) source position of every target pixel, relative to
+    the source image centre, with the radius inverted exactly for each pixel."""
+    nCenterRow = nSourceHeight//2
+    nCenterCol = nSourceWidth//2
+    fRsquaredMax = nCenterRow**2+nCenterCol**2
+    arrRow = np.arange(nTargetHeight)[:, np.newaxis] - nTargetHeight//2
+    arrCol = np.arange(nTargetWidth)[np.newaxis, :] - nTargetWidth//2
+    # the radial scale only depends on |row| and |col|, so solve one quadrant and mirror it
+    arrQuadrantRow = np.arange(nTargetHeight//2+1)[:, np.newaxis]
+    arrQuadrantCol = np.arange(nTargetWidth//2+1)[np.newaxis, :]
+    arrDist = sourceRsquared((arrQuadrantRow**2+arrQuadrantCol**2)/fRsquaredMax, fK)
+    arrScale = (1+fK*arrDist)[np.abs(arrRow), np.abs(arrCol)]
+    return arrRow/arrScale, arrCol/arrScale
+
+def sourceCoordinates(fK, nSourceHeight, nSourceWidth, nTargetHeight, nTargetWidth):
+    """Nearest-pixel version of sourceOffsets(): returns the (row, col) arrays
+    of the source pixel for every target pixel. Out-of-range source coordinates
+    are returned as-is so the caller can decide how to deal with them."""
+    arrRowOffset, arrColOffset = sourceOffsets(fK, nSourceHeight, nSourceWidth, nTargetHeight, nTargetWidth)
+    arrSourceRow = arrRowOffset.astype(int)+nSourceHeight//2 # astype() truncates towards zero, like int()
+    arrSourceCol = arrColOffset.astype(int)+nSourceWidth//2
+    return arrSourceRow, arrSourceCol
 
 class Unwarper:
     
@@ -65,124 +125,279 @@ class Unwarper:
         
         self.fK = fK
 
-        nSteps = 100 # size of radius mapping array
-        self.fRsquaredStep = 1/nSteps # used to index source distance array
-        self.lstSourceRsquared = []
-        for nI in range(nSteps+20): # go beyond 1 to allow for interpolation
-            fTargetRsquared = self.fRsquaredStep*nI
-            self.lstSourceRsquared.append(distanceFunction(fTargetRsquared, self.fK))
-
-    def distanceMap(self, fTargetRsquared):
-        # map the unwarped distance (target) to the warped distance (source) 
-        fIndex = fTargetRsquared/self.fRsquaredStep
-        nIndex = int(fIndex)
-        fLow = self.lstSourceRsquared[nIndex]
-        fHigh = self.lstSourceRsquared[nIndex+1]
-        fSourceRsquared = fLow + (fHigh-fLow)*(fIndex-nIndex)
-        return fSourceRsquared
-        
     def unwarpImage(self, arrImage, nPadding=0):
         """This applies the Tsai camera model unwarping factor
         to an image. The radial distance is scaled to the image
-        size so that K is independent of image size."""
-        nCenterRow = arrImage.shape[0]//2
-        nCenterCol = arrImage.shape[1]//2
-        fRsquaredMax = nCenterRow**2+nCenterCol**2
+        size so that K is independent of image size.
+
+        The whole target raster is handled at once: the coordinate grids,
+        radius inversion and source coordinates are computed as arrays and
+        the source pixels are pulled with a single fancy-index gather."""
         arrUnwarped = np.array(arrImage)
         if nPadding:
             arrUnwarped = np.pad(arrUnwarped, ((nPadding, nPadding), (nPadding, nPadding), (0, 0)), constant_values=0)
-        nTargetCenterRow = arrUnwarped.shape[0]//2
-        nTargetCenterCol = arrUnwarped.shape[1]//2
-        for nRow in range(arrUnwarped.shape[0]):
-            for nCol in range(arrUnwarped.shape[1]):
-                # unlike the unwarping of points, here pull rather than push
-                # to ensure that every target pixel gets filled.
-                fDist = ((nRow-nTargetCenterRow)**2+(nCol-nTargetCenterCol)**2)/fRsquaredMax
-                fDist = self.lstSourceRsquared[int(fDist/self.fRsquaredStep)] # 15% faster than distanceMap()
-                nSourceRow = int((nRow - nTargetCenterRow)/(1+self.fK*fDist))+nCenterRow
-                nSourceCol = int((nCol - nTargetCenterCol)/(1+self.fK*fDist))+nCenterCol
-                if self.fK < 0 or nPadding > 0:
-                    if nSourceRow >= 0 and nSourceRow < arrImage.shape[0]:
-                        if nSourceCol >= 0 and nSourceCol < arrImage.shape[1]:
-                            arrUnwarped[nRow, nCol] = arrImage[nSourceRow, nSourceCol]
-                else:
-                        arrUnwarped[nRow, nCol] = arrImage[nSourceRow, nSourceCol]
+        arrSourceRow, arrSourceCol = sourceCoordinates(self.fK, arrImage.shape[0], arrImage.shape[1], arrUnwarped.shape[0], arrUnwarped.shape[1])
+        if self.fK < 0 or nPadding > 0:
+            # target pixels that fall outside the source keep their original value
+            arrInside = (arrSourceRow >= 0) & (arrSourceRow < arrImage.shape[0]) & (arrSourceCol >= 0) & (arrSourceCol < arrImage.shape[1])
+            arrUnwarped[arrInside] = arrImage[arrSourceRow[arrInside], arrSourceCol[arrInside]]
+        else:
+            arrUnwarped[:, :] = arrImage[arrSourceRow, arrSourceCol]
                     
         return arrUnwarped
 
 class PrecomputedUnwarper:
     """
-    This is an attempt to speed things up by precomputing the unwarping
-    map. It does not work.
+    This speeds things up by precomputing the unwarping map, which is
+    kept in the on-disk map cache so it only has to be built once for a given
+    set of parameters.
+
+    By default each target pixel takes the nearest source pixel. In bilinear
+    mode the map holds the top-left of the four source neighbours of each
+    target pixel, and a second array holds the fractional (row, col) position
+    within that 2x2 block, from which the four weights follow. This smooths
+    the jaggies nearest-neighbour sampling leaves on well edges.
     """
     
-    def __init__(self, fK, nSourceWidth, nSourceHeight, nPadding):
+    def __init__(self, fK, nSourceWidth, nSourceHeight, nPadding, pMapCache=None, bMemoryMap=False, bBilinear=False):
         
         self.fK = fK
         self.nSourceWidth = nSourceWidth
         self.nSourceHeight = nSourceHeight
         self.nPadding = nPadding
+        self.pMapCache = pMapCache if pMapCache else MapCache()
+        self.bMemoryMap = bMemoryMap # share read-only map pages with other processes
+        self.bBilinear = bBilinear
 
-        nSteps = 100 # size of radius mapping array
-        self.fRsquaredStep = 1/nSteps # used to index source distance array
-        self.lstSourceRsquared = []
-        for nI in range(nSteps+50): # go beyond 1 to allow for interpolation
-            fTargetRsquared = self.fRsquaredStep*nI
-            self.lstSourceRsquared.append(distanceFunction(fTargetRsquared, self.fK))
-            
         self.generateMap()
 
-    def distanceMap(self, fTargetRsquared):
-        # map the unwarped distance (target) to the warped distance (source) 
-        fIndex = fTargetRsquared/self.fRsquaredStep
-        nIndex = int(fIndex)
-        fLow = self.lstSourceRsquared[nIndex]
-        fHigh = self.lstSourceRsquared[nIndex+1]
-        fSourceRsquared = fLow + (fHigh-fLow)*(fIndex-nIndex)
-        return fSourceRsquared
-        
     def generateMap(self):
         """This precomputes the Tsai camera model unwarping map
         for an image. The radial distance is scaled to the image
         size so that K is independent of image size."""
-        nCenterRow = self.nSourceHeight//2
-        nCenterCol = self.nSourceWidth//2
-        fRsquaredMax = nCenterRow**2+nCenterCol**2
         self.nTargetHeight = self.nSourceHeight+self.nPadding*2
         self.nTargetWidth = self.nSourceWidth+self.nPadding*2
-        nTargetCenterRow = self.nTargetHeight//2
-        nTargetCenterCol = self.nTargetWidth//2
 
-        strFilename = "unwarp_map_"+str(self.nTargetHeight)+"_"+str(self.nTargetWidth)+".npy"
-        if os.path.exists(strFilename):
-            self.arrFlatMap = np.load(strFilename)
+        if self.bBilinear:
+            self.arrMap, self.arrWeights = self.loadMaps(["bilinear_index", "bilinear_weights"], self.buildBilinearMap)
         else:
-            self.arrFlatMap = np.zeros([self.nTargetHeight*self.nTargetWidth*nColors], dtype=int)
-            for nRow in range(self.nTargetHeight):
-                for nCol in range(self.nTargetWidth):
-                    # unlike the unwarping of points, here pull rather than push
-                    # to ensure that every target pixel gets filled.
-                    fDist = ((nRow-nTargetCenterRow)**2+(nCol-nTargetCenterCol)**2)/fRsquaredMax
-                    fDist = self.lstSourceRsquared[int(fDist/self.fRsquaredStep)] # 15% faster than distanceMap()
-                    nSourceRow = int((nRow - nTargetCenterRow)/(1+self.fK*fDist))+nCenterRow
-                    nSourceCol = int((nCol - nTargetCenterCol)/(1+self.fK*fDist))+nCenterCol
-                    if nSourceRow >= 0 and nSourceRow < self.nSourceHeight:
-                        if nSourceCol >= 0 and nSourceCol < self.nSourceWidth:
-                            for nRGB in range(nColors):
-                                self.arrFlatMap[nRow*self.nTargetWidth*nColors+nCol*nColors+nRGB] = nSourceRow*self.nSourceWidth*nColors+nSourceCol*nColors+nRGB
-            np.save(strFilename, self.arrFlatMap)
-            
-    def unwarpImage(self, arrImage):
+            self.arrMap, = self.loadMaps(["nearest"], lambda: [self.buildMap()])
+        self.arrOutside = None # found on first use so opening a mapped map reads nothing
+
+    def loadMaps(self, lstKinds, fnBuild):
+        # fetch a set of maps from the cache, building and caching all of them if any is missing
+        lstKeys = [mapKey(strKind, self.fK, self.nSourceWidth, self.nSourceHeight, self.nPadding) for strKind in lstKinds]
+        lstMaps = [self.pMapCache.load(strKey, self.bMemoryMap) for strKey in lstKeys]
+        if any(arrMap is None or arrMap.shape[:2] != (self.nTargetHeight, self.nTargetWidth) for arrMap in lstMaps):
+            lstMaps = list(fnBuild())
+            self.pMapCache.save(lstKeys, lstMaps)
+            if self.bMemoryMap: # swap our private copies for the shared ones, where they were saved
+                for nI, strKey in enumerate(lstKeys):
+                    arrMapped = self.pMapCache.load(strKey, self.bMemoryMap)
+                    if arrMapped is not None:
+                        lstMaps[nI] = arrMapped
+        return lstMaps
+
+    def buildMap(self):
+        """Computes the whole map in one array pass. The map holds one int32
+        source pixel index (row*width+col) per target pixel, shared by all
+        colour channels, with nOutside for pixels that have no source."""
+        arrSourceRow, arrSourceCol = sourceCoordinates(self.fK, self.nSourceHeight, self.nSourceWidth, self.nTargetHeight, self.nTargetWidth)
+        arrInside = (arrSourceRow >= 0) & (arrSourceRow < self.nSourceHeight) & (arrSourceCol >= 0) & (arrSourceCol < self.nSourceWidth)
+        arrMap = (arrSourceRow*self.nSourceWidth+arrSourceCol).astype(np.int32)
+        arrMap[~arrInside] = nOutside
+        return arrMap
+
+    def buildBilinearMap(self):
+        """Computes the bilinear map: the int32 index of the top-left source
+        neighbour of every target pixel (nOutside where the nearest map has
+        no source either), and a float32 (row, col) fraction per pixel. Source
+        positions within half a pixel of the edge are clamped onto it."""
+        arrRowOffset, arrColOffset = sourceOffsets(self.fK, self.nSourceHeight, self.nSourceWidth, self.nTargetHeight, self.nTargetWidth)
+        arrSourceRow = np.clip(arrRowOffset+self.nSourceHeight//2, 0, self.nSourceHeight-1)
+        arrSourceCol = np.clip(arrColOffset+self.nSourceWidth//2, 0, self.nSourceWidth-1)
+        arrTopRow = np.minimum(arrSourceRow.astype(int), self.nSourceHeight-2)
+        arrLeftCol = np.minimum(arrSourceCol.astype(int), self.nSourceWidth-2)
+        arrMap = (arrTopRow*self.nSourceWidth+arrLeftCol).astype(np.int32)
+        arrMap[self.buildMap() == nOutside] = nOutside
+        arrWeights = np.stack([arrSourceRow-arrTopRow, arrSourceCol-arrLeftCol], axis=2).astype(np.float32)
+        return arrMap, arrWeights
+
+    def unwarpImage(self, arrImage, nThreads=1, arrUnwarped=None):
         """This applies the Tsai camera model unwarping factor
         to an image. The radial distance is scaled to the image
-        size so that K is independent of image size."""
-        return arrImage.flatten()[self.arrFlatMap].reshape([self.nTargetHeight, self.nTargetWidth, 3])
+        size so that K is independent of image size.
+
+        The image is viewed as a (pixels, colours) array, so all three
+        channels are pulled by one gather without copying the input, and
+        target pixels with no source are set to black.
+        
+        The target is filled in horizontal strips of nStripRows rows, so no
+        temporary is bigger than a strip. With nThreads > 1 the strips are
+        handed out to a thread pool, which spreads full resolution unwarps
+        over all the cores because numpy releases the GIL in the gathers.
+        
+        arrUnwarped is an optional target-sized buffer to unwarp into, so a
+        caller can reuse it from image to image."""
+        if self.arrOutside is None: # short list, cheaper than masking every call
+            self.arrOutside = np.flatnonzero(self.arrMap == nOutside)
+        arrPixels = arrImage.reshape([-1, nColors])
+        if arrUnwarped is None:
+            arrUnwarped = np.empty([self.nTargetHeight, self.nTargetWidth, nColors], dtype=arrImage.dtype)
+        lstStrips = [(nStartRow, min(nStartRow+nStripRows, self.nTargetHeight)) for nStartRow in range(0, self.nTargetHeight, nStripRows)]
+        if nThreads > 1 and len(lstStrips) > 1:
+            with ThreadPoolExecutor(max_workers=nThreads) as pPool:
+                list(pPool.map(lambda tupStrip: self.unwarpStrip(arrPixels, arrUnwarped, *tupStrip), lstStrips))
+        else:
+            for nStartRow, nEndRow in lstStrips:
+                self.unwarpStrip(arrPixels, arrUnwarped, nStartRow, nEndRow)
+        return arrUnwarped
+
+    def unwarpStrip(self, arrPixels, arrUnwarped, nStartRow, nEndRow):
+        # fill target rows [nStartRow, nEndRow) in place, strips never overlap so threads can share arrUnwarped
+        arrStrip = arrUnwarped[nStartRow:nEndRow]
+        if self.bBilinear:
+            arrStrip[:] = self.interpolate(arrPixels, nStartRow, nEndRow)
+        else:
+            np.take(arrPixels, self.arrMap[nStartRow:nEndRow], axis=0, mode="clip", out=arrStrip)
+        nStart, nEnd = np.searchsorted(self.arrOutside, [nStartRow*self.nTargetWidth, nEndRow*self.nTargetWidth])
+        arrUnwarped.reshape([-1, nColors])[self.arrOutside[nStart:nEnd]] = 0
+
+    def interpolate(self, arrPixels, nStartRow, nEndRow):
+        # weighted gather of the four neighbours for a strip, done as two linear interpolations
+        arrMap = self.arrMap[nStartRow:nEndRow]
+        arrRowWeight = self.arrWeights[nStartRow:nEndRow, :, 0:1]
+        arrColWeight = self.arrWeights[nStartRow:nEndRow, :, 1:2]
+        arrTopLeft = np.take(arrPixels, arrMap, axis=0, mode="clip").astype(np.float32)
+        arrTopRight = np.take(arrPixels, arrMap+1, axis=0, mode="clip").astype(np.float32)
+        arrTopRight -= arrTopLeft
+        arrTopRight *= arrColWeight
+        arrTopLeft += arrTopRight # top row interpolated
+        arrBottomLeft = np.take(arrPixels, arrMap+self.nSourceWidth, axis=0, mode="clip").astype(np.float32)
+        arrBottomRight = np.take(arrPixels, arrMap+(self.nSourceWidth+1), axis=0, mode="clip").astype(np.float32)
+        arrBottomRight -= arrBottomLeft
+        arrBottomRight *= arrColWeight
+        arrBottomLeft += arrBottomRight # bottom row interpolated
+        arrBottomLeft -= arrTopLeft
+        arrBottomLeft *= arrRowWeight
+        arrTopLeft += arrBottomLeft
+        return np.rint(arrTopLeft, out=arrTopLeft).astype(np.uint8)
                     
+class TsaiGeometry:
+    """
+    Maps points, rather than pixels, between the distorted source image and
+    the padded, undistorted target frame the unwarpers produce. This lets us
+    keep rectilinear geometry for the well lattice while working on the raw
+    image, without warping it at all. Takes and returns float arrays (or
+    scalars), in (row, col) order.
+    """
+
+    def __init__(self, fK, nSourceWidth, nSourceHeight, nPadding):
+        self.fK = fK
+        self.nSourceCenterRow = nSourceHeight//2
+        self.nSourceCenterCol = nSourceWidth//2
+        self.nTargetCenterRow = (nSourceHeight+nPadding*2)//2
+        self.nTargetCenterCol = (nSourceWidth+nPadding*2)//2
+        self.fRsquaredMax = self.nSourceCenterRow**2+self.nSourceCenterCol**2
+
+    def sourcePoints(self, arrRow, arrCol):
+        # undistorted target -> distorted source, the same pull model as the maps
+        arrRow = np.asarray(arrRow, dtype=float) - self.nTargetCenterRow
+        arrCol = np.asarray(arrCol, dtype=float) - self.nTargetCenterCol
+        arrScale = 1+self.fK*sourceRsquared((arrRow**2+arrCol**2)/self.fRsquaredMax, self.fK)
+        return arrRow/arrScale + self.nSourceCenterRow, arrCol/arrScale + self.nSourceCenterCol
+
+    def targetPoints(self, arrRow, arrCol):
+        # distorted source -> undistorted target, the Tsai model as written above
+        arrRow = np.asarray(arrRow, dtype=float) - self.nSourceCenterRow
+        arrCol = np.asarray(arrCol, dtype=float) - self.nSourceCenterCol
+        arrScale = 1+self.fK*(arrRow**2+arrCol**2)/self.fRsquaredMax
+        return arrRow*arrScale + self.nTargetCenterRow, arrCol*arrScale + self.nTargetCenterCol
+
+mapUnwarpers = {} # process-wide registry of warm unwarpers, keyed on their parameters
+pUnwarpersLock = threading.Lock()
+
+def getUnwarper(fK, nSourceWidth, nSourceHeight, nPadding, bMemoryMap=False, bBilinear=False):
+    """Returns a shared PrecomputedUnwarper for these parameters, building it
+    on first use. Later trays in the same process get the warm unwarper, with
+    its radius table and map already in place, at no cost."""
+    tupKey = (float(fK), nSourceWidth, nSourceHeight, nPadding, bMemoryMap, bBilinear)
+    with pUnwarpersLock:
+        if tupKey not in mapUnwarpers:
+            mapUnwarpers[tupKey] = PrecomputedUnwarper(fK, nSourceWidth, nSourceHeight, nPadding, bMemoryMap=bMemoryMap, bBilinear=bBilinear)
+        return mapUnwarpers[tupKey]
+
 if __name__ == "__main__":
     from PIL import Image
+    import tempfile
     from time import time
     
     fK = 0.1322595
+    pTestCache = MapCache(tempfile.mkdtemp()) # keep test maps, including K < 0 ones, out of the real cache
+
+    if False: # check the vectorized map builder against the original loop on a small image
+        def distanceFunction(fTargetRsquared, fK):
+            # the "right" way to get the distorted distance from the undistorted value, but fantastically slow
+            return (np.roots([fK, 0, 1, -math.sqrt(fTargetRsquared)])[-1].real)**2
+
+        def buildMapLoop(pUnwarper):
+            # the original pixel-by-pixel map construction, solving for the radius with np.roots at every pixel
+            nCenterRow = pUnwarper.nSourceHeight//2
+            nCenterCol = pUnwarper.nSourceWidth//2
+            fRsquaredMax = nCenterRow**2+nCenterCol**2
+            nTargetCenterRow = pUnwarper.nTargetHeight//2
+            nTargetCenterCol = pUnwarper.nTargetWidth//2
+            arrMap = np.full([pUnwarper.nTargetHeight, pUnwarper.nTargetWidth], nOutside, dtype=np.int32)
+            for nRow in range(pUnwarper.nTargetHeight):
+                for nCol in range(pUnwarper.nTargetWidth):
+                    # unlike the unwarping of points, here pull rather than push
+                    # to ensure that every target pixel gets filled.
+                    fDist = ((nRow-nTargetCenterRow)**2+(nCol-nTargetCenterCol)**2)/fRsquaredMax
+                    fDist = distanceFunction(fDist, pUnwarper.fK)
+                    nSourceRow = int((nRow - nTargetCenterRow)/(1+pUnwarper.fK*fDist))+nCenterRow
+                    nSourceCol = int((nCol - nTargetCenterCol)/(1+pUnwarper.fK*fDist))+nCenterCol
+                    if nSourceRow >= 0 and nSourceRow < pUnwarper.nSourceHeight:
+                        if nSourceCol >= 0 and nSourceCol < pUnwarper.nSourceWidth:
+                            arrMap[nRow, nCol] = nSourceRow*pUnwarper.nSourceWidth+nSourceCol
+            return arrMap
+
+        for nWidth, nHeight, nSmallPadding in [(64, 48, 2), (83, 61, 3)]:
+            for fTestK in [fK, -0.1]:
+                pSmall = PrecomputedUnwarper(fTestK, nWidth, nHeight, nSmallPadding, pTestCache)
+                assert np.array_equal(pSmall.buildMap(), buildMapLoop(pSmall)), (nWidth, nHeight, fTestK)
+        print("buildMap matches buildMapLoop")
+        try: # with K < 0 there is no source radius past the fold of the cubic
+            sourceRsquared(np.linspace(0, 1.2, 100), -0.3)
+            assert False, "no error past the fold"
+        except ValueError as e:
+            print(e)
+
+    if False: # cost of bilinear sampling relative to the nearest-neighbour map
+        arrTest = np.random.default_rng(0).integers(0, 256, (480, 640, nColors), dtype=np.uint8)
+        for bBilinear in [False, True]:
+            pTest = PrecomputedUnwarper(fK, 640, 480, 20, pTestCache, bBilinear=bBilinear)
+            pTest.unwarpImage(arrTest)
+            fStartTime = time()
+            for nI in range(20):
+                pTest.unwarpImage(arrTest)
+            print("Bilinear" if bBilinear else "Nearest", "unwarp 640x480:", (time()-fStartTime)/20)
+
+    if False: # strip-parallel full resolution unwarp: throughput and peak memory against thread count
+        import tracemalloc
+        arrCapture = np.random.default_rng(0).integers(0, 256, (3040, 4056, nColors), dtype=np.uint8)
+        for bBilinear in [False, True]:
+            pFull = PrecomputedUnwarper(fK, 4056, 3040, 200, pTestCache, bBilinear=bBilinear)
+            arrReference = pFull.unwarpImage(arrCapture)
+            for nThreads in range(1, max(4, os.cpu_count() or 1)+1): # at least the four cores of the Pi
+                tracemalloc.start()
+                fStartTime = time()
+                arrUnwarped = pFull.unwarpImage(arrCapture, nThreads)
+                fTime = time()-fStartTime
+                nPeak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                assert np.array_equal(arrUnwarped, arrReference)
+                print("Bilinear" if bBilinear else "Nearest", nThreads, "threads:", fTime, "s,", 
+                      arrUnwarped.shape[0]*arrUnwarped.shape[1]/fTime/1E6, "Mpix/s, peak", nPeak//(1024*1024), "MB (output", arrUnwarped.nbytes//(1024*1024), "MB)")
 
     if False:
         pUnwarper = Unwarper(fK)
@@ -229,7 +444,7 @@ if __name__ == "__main__":
             arrImage = np.array(pImage) # RGB image array
             
             fStartTime = time()
-            arrUnwarped = pUnwarper.unwarpImage(arrImage)
+            arrUnwarped = pUnwarper.unwarpImage(arrImage, os.cpu_count() or 1)
             print(time() - fStartTime)
             pUnwarped = Image.fromarray(arrUnwarped)
             pUnwarped.save(strImageFile.replace(".tiff", "_precomputed_unwarp.png"))
@@ -3,6 +3,8 @@ import numpy as np
 import os
 from PIL import Image
 
+from well import labelImage, flagImage
+
 # helper function to save intermediate steps of processing to various places
 def saveto(strImageFile, arrImage, strType):
     strDir, strFile = os.path.split(strImageFile)
@@ -24,17 +26,14 @@ def saveColumn(strImageFile, arrImage, strType, nColumnIndex):
         for nI, nValue in enumerate(lstDiff):
             outFile.write(" ".join(map(str, [nI, nValue]))+"\n")
 
-def writeColorData(strFilename, lstPixels, arrImage, bRB = False):
+def writeColorData(strFilename, arrRows, arrCols, arrImage, bRB = False):
+    arrValues = arrImage[arrRows, arrCols] # one gather for the whole well
     with open(strFilename, "w") as outFile:
-        arrRGB = np.array([0., 0., 0.])
-        for (nRow, nCol) in lstPixels:
-            if bRB:
-                outFile.write(str(arrImage[nRow, nCol][0])+" "+str(arrImage[nRow, nCol][2])+"\n")
-            else:
-                outFile.write(" ".join(map(str, arrImage[nRow, nCol]))+" "+str(nRow)+" "+str(nCol)+"\n")
-            arrRGB += arrImage[nRow, nCol]
-        if len(lstPixels):
-            arrRGB /= len(lstPixels)
+        if bRB:
+            outFile.writelines([str(nR)+" "+str(nB)+"\n" for nR, nG, nB in arrValues.tolist()])
+        else:
+            outFile.writelines([" ".join(map(str, lstRGB))+" "+str(nRow)+" "+str(nCol)+"\n"
+                                for lstRGB, nRow, nCol in zip(arrValues.tolist(), arrRows.tolist(), arrCols.tolist())])
 
 def writeColors(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow, bUV):
     # write colors to file for analysis
@@ -83,8 +82,8 @@ def writeColors(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow, b
                     else:
                         strSecondary = os.path.join(strNegDirVis, "big_"+str(nCount)+".dat")
             nCount += 1
-            writeColorData(strFilename, pWell.lstPixels, arrImage)
-            writeColorData(strSecondary, pWell.lstPixels, arrImage, True)
+            writeColorData(strFilename, pWell.arrRows, pWell.arrCols, arrImage)
+            writeColorData(strSecondary, pWell.arrRows, pWell.arrCols, arrImage, True)
             
     nCount = 0
     for nWellRow, lstRow in enumerate(lstSmallWells):                
@@ -114,8 +113,8 @@ def writeColors(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow, b
                     else:
                         strSecondary = os.path.join(strNegDirVis, "small_"+str(nCount)+".dat")
             nCount += 1
-            writeColorData(strFilename, pWell.lstPixels, arrImage)
-            writeColorData(strSecondary, pWell.lstPixels, arrImage, True)
+            writeColorData(strFilename, pWell.arrRows, pWell.arrCols, arrImage)
+            writeColorData(strSecondary, pWell.arrRows, pWell.arrCols, arrImage, True)
                 
     # overflow well
     nCount = 0
@@ -143,30 +142,29 @@ def writeColors(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow, b
                 strSecondary = os.path.join(strNegDirUV, "overflow_"+str(nCount)+".dat")
             else:
                 strSecondary = os.path.join(strNegDirVis, "overflow_"+str(nCount)+".dat")
-    writeColorData(strFilename, pOverflow.lstPixels, arrImage)
-    writeColorData(strSecondary, pOverflow.lstPixels, arrImage, True)
+    writeColorData(strFilename, pOverflow.arrRows, pOverflow.arrCols, arrImage)
+    writeColorData(strSecondary, pOverflow.arrRows, pOverflow.arrCols, arrImage, True)
         
-# dump image showing wells and overflow well
-def writeFilled(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow):
-    lstRED = [255, 0 , 0]
-    lstBLUE = [0, 0 , 255]
-    arrImage = np.array(arrImage)
+# mark the centre of each well
+def markCentres(arrImage, lstBigWells, lstSmallWells, lstColor):
     for lstRow in lstBigWells:         
         for pWell in lstRow:
-            for (nRow, nCol) in pWell.lstPixels:
-                arrImage[nRow, nCol] = lstRED
-            arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstBLUE
+            arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstColor
     for lstRow in lstSmallWells:                
         for pWell in lstRow:
-            for (nRow, nCol) in pWell.lstPixels:
-                arrImage[nRow, nCol] = lstRED
             if pWell.nPixelRow > 0: # mark center
-                arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstBLUE
+                arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstColor
             else:
-                arrImage[pWell.nRow, pWell.nCol] = lstBLUE
-    # overflow well
-    for (nRow, nCol) in pOverflow.lstPixels:
-        arrImage[nRow, nCol] = lstRED
+                arrImage[pWell.nRow, pWell.nCol] = lstColor
+
+# dump image showing wells and overflow well
+def writeFilled(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow):
+    lstRED = [255, 0 , 0]
+    lstBLUE = [0, 0 , 255]
+    arrImage = np.array(arrImage)
+    lstWells = [pWell for lstRow in lstBigWells+lstSmallWells for pWell in lstRow]+[pOverflow]
+    arrImage[labelImage(lstWells, arrImage.shape[:2]) > 0] = lstRED # every well, overflow included
+    markCentres(arrImage, lstBigWells, lstSmallWells, lstBLUE)
 
     # save image with filled in well pixels
     saveto(strImageFile, arrImage, "filled")
@@ -178,25 +176,9 @@ def writeFlagged(arrImage, strImageFile, lstBigWells, lstSmallWells, pOverflow):
     lstRED = [255, 0 , 0]
     lstBLUE = [0, 0 , 255]
     arrImage = np.array(arrImage)
-    for lstRow in lstBigWells:         
-        for pWell in lstRow:
-            for nI, (nRow, nCol) in enumerate(pWell.lstPixels):
-                if pWell.lstPositive[nI]:
-                    arrImage[nRow, nCol] = lstRED
-            arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstBLUE
-    for lstRow in lstSmallWells:                
-        for pWell in lstRow:
-            for nI, (nRow, nCol) in enumerate(pWell.lstPixels):
-                if pWell.lstPositive[nI]:
-                    arrImage[nRow, nCol] = lstRED
-            if pWell.nPixelRow > 0: # mark center
-                arrImage[pWell.nPixelRow, pWell.nPixelCol] = lstBLUE
-            else:
-                arrImage[pWell.nRow, pWell.nCol] = lstBLUE
-    # overflow well
-    for nI, (nRow, nCol) in enumerate(pOverflow.lstPixels):
-        if pOverflow.lstPositive[nI]:
-            arrImage[nRow, nCol] = lstRED
+    lstWells = [pWell for lstRow in lstBigWells+lstSmallWells for pWell in lstRow]+[pOverflow]
+    arrImage[flagImage(lstWells, arrImage.shape[:2]) > 0] = lstRED # positive pixels of every well, overflow included
+    markCentres(arrImage, lstBigWells, lstSmallWells, lstBLUE)
 
     # save image with filled in well pixels
     saveto(strImageFile, arrImage, "flagged")
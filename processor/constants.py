@@ -1,3 +1,5 @@
+import os
+
 # these are approximate numbers based on measurements from Eric's
 # QuantiTray carrier SolidWorks (.STL) file. Wells are positioned on
 # their centre, as the CoM of a blob of pixels is easier to define than
@@ -22,7 +24,7 @@ nLowerThreshold = 100 # removes background pixels
 nSinceThreshold = 25 # grey levels we have to pass without a new low before calling it
 
 nHighThresholdLimit = 250 # if threshold exceeds this, use BG multiplier to get threshold
-fBackgroundMutltiplier = 3
+fBackgroundMultiplier = 3
 
 # THIS IS THE RESOLUTION OF THE ANALYZED IMAGES
 # if it changes, various numbers below need to change
@@ -49,3 +51,18 @@ fWellFactorReduction = 0.99
 
 fK = 0.1322595 # Tsai model unwarping parameter for -2 cm images
 nPadding = 20 # padding around unwarped images
+
+# precomputed unwarp maps are cached here, keyed on everything that goes into them
+strMapCacheDir = os.path.join(os.path.expanduser("~"), ".cache", "uvreader", "unwarp_maps")
+nMapCacheBudget_MB = 256 # least recently used maps are deleted beyond this
+bMemoryMapUnwarpMaps = True # share cached maps through the page cache instead of loading private copies
+bBilinearUnwarp = False # bilinear instead of nearest-neighbour sampling when unwarping (~10x the cost of the gather)
+bGeometryOnly = False # find wells on the distorted image and unwarp only their co-ordinates
+bLatticeLocator = False # place every well at once by template matching the whole lattice, instead of walking from the origin well
+lstLatticeScales = [0.94, 0.97, 1.0, 1.03, 1.06] # factors on the scale from the tray rectangle tried by the lattice locator
+fLatticeMinScore = 0.5 # lattice locator matches scoring under this are not a tray (trays score about 0.8)
+nLatticeStep = 2 # the lattice locator searches an image reduced by this in each direction
+fLatticeOutlierFactor = 3.0 # wells further than this many median residuals off the fitted lattice are dropped from the fit
+fLatticeOutlierFloor = 2.0*nTargetWidth/nDefaultTargetWidth # pixels, residuals under this are never outliers
+fLatticeScaleTolerance = 0.1 # a lattice fit whose scale is further than this fraction from the measured scale is not trusted
+fLatticeMinInliers = 0.5 # nor one that fits fewer than this fraction of the wells
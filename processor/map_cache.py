@@ -0,0 +1,101 @@
+import numpy as np
+import os
+import tempfile
+
+from constants import strMapCacheDir, nMapCacheBudget_MB
+
+class MapCache:
+    """
+    On-disk store for precomputed unwarp maps. Each map lives in its own .npy
+    file named by a key that has to cover everything the map depends on, so a
+    change in any parameter gives a new file rather than silently reusing a
+    wrong map.
+
+    Maps are written to a temporary file in the cache directory and renamed
+    into place, which is atomic, so a second process either sees the whole
+    map or nothing. Loading a map touches its modification time, and once the
+    directory grows past the size budget the least recently used maps are
+    deleted. Maps used together are saved together, so none of a set is
+    deleted to make room for the rest of it.
+    """
+    def __init__(self, strDirectory=strMapCacheDir, nBudget_MB=nMapCacheBudget_MB):
+        self.strDirectory = strDirectory
+        self.nBudget = nBudget_MB*1024*1024
+
+    def getFilename(self, strKey):
+        return os.path.join(self.strDirectory, strKey+".npy")
+
+    def load(self, strKey, bMemoryMap=False):
+        # returns None if the map is not cached (or is unreadable). Memory mapped
+        # maps are paged in on demand and share the page cache between processes
+        strFilename = self.getFilename(strKey)
+        if not os.path.exists(strFilename):
+            return None
+        try:
+            arrMap = np.load(strFilename, mmap_mode="r" if bMemoryMap else None)
+        except (OSError, ValueError) as e:
+            print("Discarding unreadable unwarp map:", strFilename, e)
+            self.remove(strFilename)
+            return None
+        self.touch(strFilename)
+        return arrMap
+
+    def save(self, lstKeys, lstMaps):
+        # saves a set of maps that are used together, then evicts once, never
+        # deleting any of the set to make room for the rest of it
+        lstFilenames = []
+        for strKey, arrMap in zip(lstKeys, lstMaps):
+            strFilename = self.getFilename(strKey)
+            try:
+                os.makedirs(self.strDirectory, exist_ok=True)
+                nHandle, strTempFilename = tempfile.mkstemp(suffix=".tmp", dir=self.strDirectory)
+                try:
+                    with os.fdopen(nHandle, "wb") as outFile:
+                        np.save(outFile, arrMap)
+                        outFile.flush()
+                        os.fsync(outFile.fileno())
+                    os.replace(strTempFilename, strFilename)
+                except BaseException:
+                    self.remove(strTempFilename)
+                    raise
+            except OSError as e: # caching is an optimization, so failure is not fatal
+                print("Could not cache unwarp map:", strFilename, e)
+                continue
+            lstFilenames.append(strFilename)
+        if lstFilenames:
+            self.evict(lstFilenames)
+
+    def evict(self, lstKeepFilenames=()):
+        # delete least recently used maps until we are within budget
+        lstEntries = []
+        nTotal = 0
+        for strFile in os.listdir(self.strDirectory):
+            if not strFile.endswith(".npy"):
+                continue
+            strFilename = os.path.join(self.strDirectory, strFile)
+            try:
+                pStat = os.stat(strFilename)
+            except OSError: # removed by another process
+                continue
+            lstEntries.append((pStat.st_mtime, pStat.st_size, strFilename))
+            nTotal += pStat.st_size
+        lstEntries.sort()
+        for fTime, nSize, strFilename in lstEntries:
+            if nTotal <= self.nBudget:
+                break
+            if strFilename in lstKeepFilenames:
+                continue
+            self.remove(strFilename)
+            nTotal -= nSize
+
+    def touch(self, strFilename):
+        try:
+            os.utime(strFilename)
+        except OSError: # read-only cache is still usable
+            pass
+
+    def remove(self, strFilename):
+        try:
+            os.remove(strFilename)
+        except OSError:
+            pass
@@ -3,65 +3,63 @@ import numpy as np
 import os
 from PIL import Image
 import sys
+import threading
 from time import time
 
 from constants import *
-from unwarp_image import PrecomputedUnwarper
-from well import Well, findWellPixels
+from lattice import wellLattice, locateLattice, fitLattice, placeLattice
+from unwarp_image import getUnwarper, TsaiGeometry, nColors
+from well import Well, findWellPixels, findWellPixelsLadder, classifyBatch
 from write_images import *
 
 # Based on early calibration images. For UV especially expect to change
 # with new camera settings.
 
 def boxcar(arrLine, nWidth):
-    # do simple boxcar smoothing, ignoring the ends
+    # do simple boxcar smoothing along the first axis, ignoring the ends. Each window
+    # is a difference of running sums, so a (pixels, colours) row does all bands at once
     arrOut = np.array(arrLine)
     nHalfWidth = nWidth//2
-    for nI in range(arrLine.shape[0]):
-        if nI >= nHalfWidth and nI < arrLine.shape[0]-nHalfWidth:
-            arrOut[nI] = sum(arrLine[nI-nHalfWidth: nI+nHalfWidth])/nWidth
+    if arrLine.shape[0] > 2*nHalfWidth:
+        arrSum = np.cumsum(arrLine, axis=0, dtype=float)
+        arrSum = np.concatenate([np.zeros((1,)+arrSum.shape[1:]), arrSum])
+        arrOut[nHalfWidth:arrLine.shape[0]-nHalfWidth] = (arrSum[2*nHalfWidth:arrLine.shape[0]]-arrSum[:arrLine.shape[0]-2*nHalfWidth])/nWidth
 
     return arrOut
     
 def findEdge(arrImage, nColumnIndex, nStartRow, nEndRow):
-    # find an edge working down a column from the top
+    # find an edge working down a column from the top: the first biggest rise over
+    # three pixels, or 0 if the column never rises
     
-    arrColumn = np.zeros(arrImage.shape[0])
-    for nI, arrLine in enumerate(arrImage): # green column
-        arrColumn[nI] = arrLine[nColumnIndex][2]
-
-    nPeak = 0
-    fMax = 0
-    for nI in range(nStartRow, nEndRow):
-        fDiff = arrColumn[nI+3]-arrColumn[nI]
-        if fDiff > fMax:
-            fMax = fDiff
-            nPeak = nI
+    arrColumn = arrImage[:, nColumnIndex, 2].astype(float) # green column
+    arrDiff = arrColumn[nStartRow+3:nEndRow+3]-arrColumn[nStartRow:nEndRow]
+    if not len(arrDiff) or np.max(arrDiff) <= 0:
+        return 0
             
-    return nPeak
+    return nStartRow+int(np.argmax(arrDiff))
 
 def findRectangle(arrIntensity):
-    # find the basic rectangle after BG subtraction
-    nTopRow = -1
-    nEndRow = -1
-    for nI, arrRow in enumerate(arrIntensity):
-        if nTopRow < 0 and np.sum(arrRow) > nRectangleStartThreshold:
-            nTopRow = nI
-        if np.sum(arrRow) > nRectangleEndThreshold:
-            nEndRow = nI
-    for nLeftCol, arrCol in enumerate(arrIntensity.T):
-        if np.sum(arrCol) > nRectangleStartThreshold:
-            break
+    # find the basic rectangle after BG subtraction from the row and column projections.
+    # Rows are -1 if nothing is over threshold, the column is the last one
+    arrRowSum = np.sum(arrIntensity, axis=1)
+    arrColSum = np.sum(arrIntensity, axis=0)
+    arrTop = np.argwhere(arrRowSum > nRectangleStartThreshold)
+    arrEnd = np.argwhere(arrRowSum > nRectangleEndThreshold)
+    arrLeft = np.argwhere(arrColSum > nRectangleStartThreshold)
+    nTopRow = int(arrTop[0, 0]) if len(arrTop) else -1
+    nEndRow = int(arrEnd[-1, 0]) if len(arrEnd) else -1
+    nLeftCol = int(arrLeft[0, 0]) if len(arrLeft) else arrIntensity.shape[1]-1
     
     return nTopRow, nLeftCol, nEndRow
 
-def bgSubtract(arrImage):
+def bgSubtract(arrImage, pGeometry=None, arrWork=None):
+    # pGeometry is given when the image has not been unwarped, in which case the
+    # background row is followed along its curve rather than taken straight across.
+    # arrWork is an optional float32 buffer the size of the image to work in
 
-    # ensure we are above the actual well pixels
-    for nEndRow, arrRow in enumerate(arrImage[nBGStartRow:]):
-        nMax = np.max(arrRow[:, 1])
-        if nMax > nBGWellThreshold:
-            break
+    # ensure we are above the actual well pixels: first row with a bright green pixel (or the last row)
+    arrAbove = np.flatnonzero(np.max(arrImage[nBGStartRow:, :, 1], axis=1) > nBGWellThreshold)
+    nEndRow = arrAbove[0] if len(arrAbove) else arrImage.shape[0]-nBGStartRow-1
     nEndRow += nBGBoundary # step back from edge of wells
     nStartRow = nEndRow - nBGStartRow
     while nStartRow < 0:
@@ -72,19 +70,84 @@ def bgSubtract(arrImage):
     nUpperEdge = findEdge(arrImage, nColumnIndex, nStartRow, nEndRow)
     nEdge = nUpperEdge+nBGShift
     
-    arrBGRow = arrImage[nEdge].astype(float)
-    lstBands = [boxcar(arrBGRow[ :, nI], nBGWidth) for nI in range(3)]
-    for nI in range(3):
-        arrBGRow[ :, nI] = lstBands[nI]    
+    if pGeometry:
+        arrCols = np.arange(arrImage.shape[1])
+        fLatticeRow = pGeometry.targetPoints(nEdge, nColumnIndex)[0]
+        arrRows, _ = pGeometry.sourcePoints(fLatticeRow, pGeometry.targetPoints(nEdge, arrCols)[1])
+        arrRows = np.clip(np.rint(arrRows).astype(int), 0, arrImage.shape[0]-1)
+        arrBGRow = arrImage[arrRows, arrCols].astype(float)
+    else:
+        arrBGRow = arrImage[nEdge].astype(float)
+    arrBGRow = boxcar(arrBGRow, nBGWidth) # all three bands together
     fBackground = np.sum(arrBGRow)/arrBGRow.shape[0] # used for thresholding
     
-    arrDiff = arrImage.astype(float) # background-subtract, clip, and rescale
-    for nRow in range(arrImage.shape[0]):
-        arrDiff[nRow] -= arrBGRow
-    arrDiff = np.clip(arrDiff, 0, None)
-    fRatio = 254/np.max(arrDiff)
-    arrDiff *= fRatio
-    return arrDiff.astype(np.uint8), fBackground
+    if arrWork is None:
+        arrWork = np.empty(arrImage.shape, dtype=np.float32)
+    np.copyto(arrWork, arrImage) # background-subtract (broadcast over every row), clip, and rescale in one buffer
+    arrWork -= arrBGRow.astype(np.float32)
+    np.clip(arrWork, 0, None, out=arrWork)
+    arrWork *= np.float32(254/np.max(arrWork))
+    return arrWork.astype(np.uint8), fBackground
+
+def findThreshold(arrIntensity, nLower=nLowerThreshold, nSince=nSinceThreshold, arrHist=None):
+    """
+    Histograms the intensity image and finds the well threshold, which is the low point
+    above nLower. The search is cut off if there hasn't been a new low within nSince grey
+    values, which deals with noise and stops us getting caught by the drop off at the
+    upper end. Returns the threshold (0 if there are no bins above nLower) and the histogram,
+    which can be passed in if it has already been made.
+    """
+    if arrHist is None:
+        arrHist = intensityHistogram(arrIntensity)
+    arrCounts = arrHist[nLower+1:]
+    if not len(arrCounts) or nSince < 1:
+        return 0, arrHist
+    
+    # the running minimum steps down at each new low, and the search ends at the first gap
+    # between lows longer than nSince
+    arrRunningMin = np.minimum.accumulate(arrCounts)
+    arrLows = np.flatnonzero(np.concatenate([[True], arrCounts[1:] < arrRunningMin[:-1]]))
+    arrGaps = np.flatnonzero(np.diff(arrLows) > nSince)
+    nLow = arrLows[arrGaps[0]] if len(arrGaps) else arrLows[-1]
+    return int(nLow)+nLower+1, arrHist
+
+def intensityHistogram(arrIntensity, nStripRows=64):
+    # bincount works on an intp copy of its input, so count a strip of rows at a time to keep that small
+    arrHist = np.zeros(256*3, dtype=int) # 256 to make room for resampling error
+    for nStartRow in range(0, arrIntensity.shape[0], nStripRows):
+        arrHist += np.bincount(arrIntensity[nStartRow:nStartRow+nStripRows].ravel(), minlength=256*3)
+    return arrHist
+
+class Preprocessor:
+    """
+    Takes a decoded image to the background-subtracted RGB image, its intensity and
+    histogram in one stage. The unwarp and float32 working buffers are kept and reused
+    from tray to tray (they are only reallocated when the image size changes), and the
+    outputs are compact: uint8 RGB and uint16 intensity (3*255 fits easily). Only the
+    outputs are new arrays, since trays hold on to them.
+    """
+    def __init__(self):
+        self.arrUnwarped = None
+        self.arrWork = None
+        self.pLock = threading.Lock() # one set of buffers, so one tray at a time
+        
+    def getBuffer(self, arrBuffer, tupShape, dtype):
+        if arrBuffer is None or arrBuffer.shape != tupShape:
+            arrBuffer = np.empty(tupShape, dtype=dtype)
+        return arrBuffer
+
+    def process(self, arrImage, pUnwarper=None, pGeometry=None):
+        # returns the RGB image, intensity, histogram and background level
+        with self.pLock:
+            if pUnwarper:
+                self.arrUnwarped = self.getBuffer(self.arrUnwarped, (pUnwarper.nTargetHeight, pUnwarper.nTargetWidth, nColors), np.uint8)
+                arrImage = pUnwarper.unwarpImage(arrImage, arrUnwarped=self.arrUnwarped)
+            self.arrWork = self.getBuffer(self.arrWork, arrImage.shape, np.float32)
+            arrImage, fBackground = bgSubtract(arrImage, pGeometry, self.arrWork)
+        arrIntensity = np.sum(arrImage, axis=2, dtype=np.uint16)
+        return arrImage, arrIntensity, intensityHistogram(arrIntensity), fBackground
+
+pPreprocessor = Preprocessor() # shared so the buffers survive from tray to tray
 
 class NoOriginException(Exception):
     
@@ -107,8 +170,14 @@ class QuantiTray:
     
     Note that not all trays have small wells, so when that state is detected some things
     are turned off.
+    
+    In geometry-only mode the image is never unwarped. Wells are found and sampled on the
+    distorted image, and only co-ordinates are moved between the image and the rectilinear
+    (unwarped) frame the tray lattice lives in, via toImage() and toLattice(). The origin,
+    nRightCol and nBottomRow are kept in the lattice frame; well positions and pixels are
+    always in the image frame.
     """
-    def __init__(self, strImageFile, bUV, bHasSmallWells, bDebug, pCallback=None):
+    def __init__(self, strImageFile, bUV, bHasSmallWells, bDebug, pCallback=None, bGeometryOnly=bGeometryOnly, bLatticeLocator=bLatticeLocator):
 
         # image file and rough initial scale/location
         self.strImageFile = strImageFile
@@ -131,10 +200,42 @@ class QuantiTray:
             self.nSmallWellCols = 0
         
         self.bDebugOutput = bDebug
+        self.bGeometryOnly = bGeometryOnly
+        self.pGeometry = None # only needed in geometry-only mode
+        self.bLatticeLocator = bLatticeLocator
         
     def setDebugOutput(self, bDebugOutput):
         self.bDebugOutput = bDebugOutput
         
+    def setGeometryOnly(self, bGeometryOnly):
+        self.bGeometryOnly = bGeometryOnly
+
+    def setLatticeLocator(self, bLatticeLocator):
+        self.bLatticeLocator = bLatticeLocator
+        
+    def toImage(self, nRow, nCol):
+        # rectilinear lattice co-ordinates to image pixel co-ordinates
+        if not self.bGeometryOnly:
+            return nRow, nCol
+        fRow, fCol = self.pGeometry.sourcePoints(nRow, nCol)
+        return int(round(float(fRow))), int(round(float(fCol)))
+
+    def toLattice(self, nRow, nCol):
+        # image pixel co-ordinates to rectilinear lattice co-ordinates
+        if not self.bGeometryOnly:
+            return nRow, nCol
+        fRow, fCol = self.pGeometry.targetPoints(nRow, nCol)
+        return int(round(float(fRow))), int(round(float(fCol)))
+
+    def latticePosition(self, pWell):
+        return self.toLattice(pWell.nPixelRow, pWell.nPixelCol)
+
+    def moveWells(self, fnMove):
+        # move every well's position between frames with toImage or toLattice
+        for lstRow in self.lstBigWells+self.lstSmallWells:
+            for pWell in lstRow:
+                pWell.nPixelRow, pWell.nPixelCol = fnMove(pWell.nPixelRow, pWell.nPixelCol)
+
     def process(self):
         """Actually do the processing. This used to be in the constructor but
         separating it allows other state to be set before doing so, like if we
@@ -144,19 +245,23 @@ class QuantiTray:
         
         # image file as numpy array
         pImage = Image.open(self.strImageFile)
+        pUnwarper = None
         if pImage.size[0] > nTargetWidth:
             nHeight = int(pImage.size[1]*nTargetWidth/pImage.size[0])+1 # should be 480
             pImage = pImage.resize((nTargetWidth, nHeight), Image.Resampling.LANCZOS)        
             
         if self.pCallback: self.pCallback() # report progress
         
-        pUnwarper = PrecomputedUnwarper(fK, pImage.size[0], pImage.size[1], nPadding) # this gives us excellent rectilinear geometry
-        self.arrImage = pUnwarper.unwarpImage(np.array(pImage))
+        if self.bGeometryOnly: # leave the image distorted, only well co-ordinates get unwarped
+            self.pGeometry = TsaiGeometry(fK, pImage.size[0], pImage.size[1], nPadding)
+        else:
+            pUnwarper = getUnwarper(fK, pImage.size[0], pImage.size[1], nPadding, bMemoryMapUnwarpMaps, bBilinearUnwarp) # this gives us excellent rectilinear geometry
+            self.pGeometry = None
         
         if self.pCallback: self.pCallback() # report progress
         
-        self.arrImage, fBackground = bgSubtract(self.arrImage) # RGB image array
-        self.arrIntensity = np.sum(self.arrImage, axis=2)
+        # unwarp, background-subtract and histogram the RGB image array
+        self.arrImage, self.arrIntensity, self.arrHist, fBackground = pPreprocessor.process(np.array(pImage), pUnwarper, self.pGeometry)
         
         if self.bDebugOutput:
             saveto(self.strImageFile, self.arrImage, "unwarped")
@@ -165,52 +270,39 @@ class QuantiTray:
         
         # generate histogram and determine threshold, which is based on the low point above
         # 100. The "since" value cuts the search off if we haven't seen a new low after 25 grey
-        # values. This deals with noise and prevents us from getting caught by the drop off
-        # at the upper end.
-        nImax, nJmax, _ = self.arrImage.shape
-        self.lstHist = [0 for nI in range(256*3)] # 256 to make room for resampling error
-        for nI in range(nImax): # generate intensity array for basic processing, and histogram
-            for nValue in self.arrIntensity[nI, : ]:
-                self.lstHist[nValue] += 1
+        # values.
+        self.nThreshold, self.arrHist = findThreshold(self.arrIntensity, arrHist=self.arrHist)
         strHistFile = self.strImageFile.replace(".tiff", ".hst")
-        nMinCount = 1E8
-        self.nThreshold = 0
-        nSince = 0
         
         if self.bDebugOutput: # output histogram if required
             with open(strHistFile, "w") as outFile:
-                for nI, nCount in enumerate(self.lstHist):
+                for nI, nCount in enumerate(self.arrHist):
                     outFile.write(" ".join(map(str, (nI, nCount)))+"\n")
 
-        for nI, nCount in enumerate(self.lstHist): # identify threshold
-            if nI > nLowerThreshold and nSince < nSinceThreshold:
-                if nCount < nMinCount:
-                    nMinCount = nCount
-                    self.nThreshold = int(nI)
-                    nSince = 0
-                else:
-                    nSince += 1    
-
         # very high thresholds are a result of bad histogram
         if self.nThreshold > nHighThresholdLimit: # PARAMETERS
             self.nThreshold = int(fBackgroundMultiplier*fBackground)
             
         if self.pCallback: self.pCallback() # report progress
         
-        # find the upper-left big well and use it to nail down origin
-        self.findOrigin()
-
-        if self.pCallback: self.pCallback() # report progress
-        
-        # known tray geometry => this sets the scale
-        self.generateBigWells()
-        
-        if self.pCallback: self.pCallback() # report progress
-        
         self.lstSmallWells = [] # dummy for cases where we have none
-        if self.bHasSmallWells:
-            # use the big well geometry to find the small wells
-            self.generateSmallWells()        
+        if self.bLatticeLocator:
+            # place every well at once from the whole lattice, then segment them locally
+            self.locateWells()
+        else:
+            # find the upper-left big well and use it to nail down origin
+            self.findOrigin()
+
+            if self.pCallback: self.pCallback() # report progress
+            
+            # known tray geometry => this sets the scale
+            self.generateBigWells()
+            
+            if self.pCallback: self.pCallback() # report progress
+            
+            if self.bHasSmallWells:
+                # use the big well geometry to find the small wells
+                self.generateSmallWells()        
         
         if self.pCallback: self.pCallback() # report progress
         
@@ -237,43 +329,35 @@ class QuantiTray:
             nCol = self.nOriginCol                
             for nJ in range(self.nBigWellCols):
                 if self.pCallback: self.pCallback() # report progress
-                self.lstBigWells[-1].append(Well(nRow, nCol, nBigWellSize_pix, self.bUV))
+                nImageRow, nImageCol = self.toImage(nRow, nCol)
+                self.lstBigWells[-1].append(Well(nImageRow, nImageCol, nBigWellSize_pix, self.bUV))
                 
-                setWellPixels = set()
-                fFactor = 1.0
-                while not len(setWellPixels) and fFactor > fWellFactorThreshsold: # deal with bad contrast... carefully PARAMETER
-                    setWellPixels = findWellPixels(self.arrIntensity, nRow, nCol, nBigWellSize_pix, fFactor*self.nThreshold)
-                    fFactor *= fWellFactorReduction # very slow reduction PARAMETER
-                
-                lstWellPixels = []
-                lstWellValues = []
-                for (nPixelRow, nPixelCol) in setWellPixels:
-                    lstWellPixels.append((nPixelRow, nPixelCol))
-                    lstWellValues.append(self.arrImage[nPixelRow, nPixelCol])
-                self.lstBigWells[-1][-1].setPixels(lstWellPixels)
-                self.lstBigWells[-1][-1].setValues(lstWellValues)
+                # deal with bad contrast... carefully, with a very slow reduction PARAMETER
+                arrRows, arrCols = findWellPixelsLadder(self.arrIntensity, nImageRow, nImageCol, nBigWellSize_pix, self.nThreshold, fWellFactorThreshsold, fWellFactorReduction)
+                self.lstBigWells[-1][-1].setPixels(arrRows, arrCols, self.arrImage)
                 self.lstBigWells[-1][-1].findCentreFromPixels()
                 if len(self.lstBigWells[-1]) > 1:
                     if self.lstBigWells[-1][-1].nPixelCol == self.lstBigWells[-1][-2].nPixelCol:
-                        self.lstBigWells[-1][-1].nPixelCol = nCol # force approximate
+                        self.lstBigWells[-1][-1].nPixelCol = nImageCol # force approximate
                         print("Duplicate well: ", nRow, nCol, "|", self.lstBigWells[-1][-1].nPixelRow, self.lstBigWells[-1][-1].nPixelCol)
                         
                     # recompute spacing as we go in the first row
                     if not nI:
-                        nBigWellSpacing_pix = (self.lstBigWells[-1][-1].nPixelCol-self.lstBigWells[-1][0].nPixelCol)//(len(self.lstBigWells[-1])-1)
+                        nBigWellSpacing_pix = (self.latticePosition(self.lstBigWells[-1][-1])[1]-self.latticePosition(self.lstBigWells[-1][0])[1])//(len(self.lstBigWells[-1])-1)
 
                 # increment column and use previous row position to determine current one
-                nCol = self.lstBigWells[-1][-1].nPixelCol + nBigWellSpacing_pix
-                nRow = self.lstBigWells[-1][-1].nPixelRow
+                nRow, nCol = self.latticePosition(self.lstBigWells[-1][-1])
+                nCol += nBigWellSpacing_pix
                         
             if not nI: # recompute scale and origin after first row
-                self.fScale = (self.lstBigWells[-1][-1].nPixelCol-self.lstBigWells[-1][0].nPixelCol)/(fBigWellSpacing_mm*(len(self.lstBigWells[-1])-1))
-                self.nOriginRow = sum([pWell.nPixelRow for pWell in self.lstBigWells[-1]])//len(self.lstBigWells[-1])
+                lstLattice = [self.latticePosition(pWell) for pWell in self.lstBigWells[-1]]
+                self.fScale = (lstLattice[-1][1]-lstLattice[0][1])/(fBigWellSpacing_mm*(len(self.lstBigWells[-1])-1))
+                self.nOriginRow = sum([nLatticeRow for nLatticeRow, nLatticeCol in lstLattice])//len(self.lstBigWells[-1])
                 nBigWellSize_pix = int(fBigWellSize_mm*self.fScale)
                 nBigWellSpacing_pix = int(fBigWellSpacing_mm*self.fScale)
             
             # increment row based on previous row, not global co-ordinates
-            nRow = self.lstBigWells[-1][-1].nPixelRow + nBigWellSpacing_pix
+            nRow = self.latticePosition(self.lstBigWells[-1][-1])[0] + nBigWellSpacing_pix
     
     def generateSmallWells(self):
         # small wells start with the leftmost. Column major vertical
@@ -291,31 +375,27 @@ class QuantiTray:
                 if nJ == 0 and (nI ==0 or nI == self.nSmallWellRows-1):
                     continue
                 nCol = nFirstSmallWellCol_pix + nJ*nSmallWellSpacing_pix
-                self.lstSmallWells[-1].append(Well(nRow, nCol, nSmallWellSize_pix, self.bUV))
+                nImageRow, nImageCol = self.toImage(nRow, nCol)
+                self.lstSmallWells[-1].append(Well(nImageRow, nImageCol, nSmallWellSize_pix, self.bUV))
 
-                setWellPixels = set()
-                fFactor = 1.0
-                while not len(setWellPixels) and fFactor > fWellFactorThreshsold: # deal with bad contrast... carefully
-                    setWellPixels = findWellPixels(self.arrIntensity, nRow, nCol, nSmallWellSize_pix, fFactor*self.nThreshold)
-                    fFactor *= fWellFactorReduction # very slow reduction
-                
-                lstWellPixels = []
-                lstWellValues = []
-                for (nPixelRow, nPixelCol) in setWellPixels:
-                    lstWellPixels.append((nPixelRow, nPixelCol))
-                    lstWellValues.append(self.arrImage[nPixelRow, nPixelCol])
-                self.lstSmallWells[-1][-1].setPixels(lstWellPixels)
-                self.lstSmallWells[-1][-1].setValues(lstWellValues)
+                # deal with bad contrast... carefully
+                arrRows, arrCols = findWellPixelsLadder(self.arrIntensity, nImageRow, nImageCol, nSmallWellSize_pix, self.nThreshold, fWellFactorThreshsold, fWellFactorReduction)
+                self.lstSmallWells[-1][-1].setPixels(arrRows, arrCols, self.arrImage)
                 self.lstSmallWells[-1][-1].findCentreFromPixels()
             if not nI: # first row
-                nSmallWellSpacing_pix = (self.lstSmallWells[-1][-1].nPixelCol-self.lstSmallWells[-1][0].nPixelCol)//(len(self.lstSmallWells[-1])-1)
-                nSmallWellOriginRow = sum([pWell.nPixelRow for pWell in self.lstSmallWells[-1]])//len(self.lstSmallWells[-1])
+                lstLattice = [self.latticePosition(pWell) for pWell in self.lstSmallWells[-1]]
+                nSmallWellSpacing_pix = (lstLattice[-1][1]-lstLattice[0][1])//(len(self.lstSmallWells[-1])-1)
+                nSmallWellOriginRow = sum([nLatticeRow for nLatticeRow, nLatticeCol in lstLattice])//len(self.lstSmallWells[-1])
 
     def analyzeOverflow(self):
         
         # this finds the line of water fill
         self.nOverflowStartCol =  self.nRightCol + int(fOverflowXStart*self.fScale)
         self.nOverflowEndCol =  self.nRightCol + int(fOverflowXEnd*self.fScale)
+        if self.bGeometryOnly: # columns were worked out in the lattice frame, bring them into the image
+            nMidRow = (self.nOriginRow + self.nBottomRow)//2
+            self.nOverflowStartCol = self.toImage(nMidRow, self.nOverflowStartCol)[1]
+            self.nOverflowEndCol = self.toImage(nMidRow, self.nOverflowEndCol)[1]
         if self.bUV: # use red edge for UV images, blue edge for visible
             arrSum = np.sum(self.arrImage[ :, self.nOverflowStartCol:self.nOverflowEndCol, 0], 1, dtype=int)
         else:
@@ -331,20 +411,14 @@ class QuantiTray:
         nMid = (self.nOverflowEndCol + self.nOverflowStartCol)//2
         try:
             nThreshold = 0.7*self.arrIntensity[self.nOverflowLine+nRange, nMid]      # PARAMETER  
-            setOverflowPixels = findWellPixels(self.arrIntensity, self.nOverflowLine+nRange, nMid, nRange, nThreshold, self.nOverflowLine)
+            arrRows, arrCols = findWellPixels(self.arrIntensity, self.nOverflowLine+nRange, nMid, nRange, nThreshold, self.nOverflowLine)
         except IndexError as e:
             print("OVERFLOW DETECTION FAILURE")
             nOverflowRow = self.arrIntensity.shape[0]//2
             nOverflowCol = self.arrIntensity.shape[1] - nOverflowColOffset
             nThreshold = 0.7*self.arrIntensity[nOverflowRow, nOverflowCol]
         self.pOverflow = Well(0, 0, 0, self.bUV) # overflow is just a well
-        lstOverflowPixels = []
-        lstOverflowValues = []
-        for (nPixelRow, nPixelCol) in setOverflowPixels:
-            lstOverflowPixels.append((nPixelRow, nPixelCol))
-            lstOverflowValues.append(self.arrImage[nPixelRow, nPixelCol])
-        self.pOverflow.setPixels(lstOverflowPixels)
-        self.pOverflow.setValues(lstOverflowValues)
+        self.pOverflow.setPixels(arrRows, arrCols, self.arrImage)
         
         if self.bDebugOutput: # turn on/off test output
             strFilename = self.strImageFile.replace(".tiff", "_overflow.dat")
@@ -363,6 +437,10 @@ class QuantiTray:
         
         # find edges of layout. This can vary by dozens of pixels in the prototype hardware
         self.nOriginRow, self.nOriginCol, nEndRow = findRectangle(self.arrIntensity)
+        if self.bGeometryOnly: # edges bow out the most through the centre, so convert them there
+            nMidRow, nMidCol = self.arrIntensity.shape[0]//2, self.arrIntensity.shape[1]//2
+            self.nOriginRow, nEndRow = self.toLattice(self.nOriginRow, nMidCol)[0], self.toLattice(nEndRow, nMidCol)[0]
+            self.nOriginCol = self.toLattice(nMidRow, self.nOriginCol)[1]
         fPhysicalHeight = (self.nBigWellRows-1)*fBigWellSpacing_mm + fBigWellSize_mm
         nPixelHeight = nEndRow-self.nOriginRow
         self.fScale = nPixelHeight/fPhysicalHeight
@@ -374,48 +452,116 @@ class QuantiTray:
         else:
             self.nOriginCol += nBigWellSize_pix//2
 
-        setOrigin = set()
-        fFactor = 1.0
-        while not len(setOrigin) and fFactor > fWellFactorThreshsold:
-            setOrigin = findWellPixels(self.arrIntensity, self.nOriginRow, self.nOriginCol, nBigWellSize_pix, fFactor*self.nThreshold)
-            fFactor *= fWellFactorReduction # very slow reduction
+        nImageRow, nImageCol = self.toImage(self.nOriginRow, self.nOriginCol)
+        arrRows, arrCols = findWellPixelsLadder(self.arrIntensity, nImageRow, nImageCol, nBigWellSize_pix, self.nThreshold, fWellFactorThreshsold, fWellFactorReduction)
 
-        if not len(setOrigin): # not able to find origin
+        if not len(arrRows): # not able to find origin
             raise NoOriginException(self.strImageFile)
             
-        self.nOriginRow = 0
-        self.nOriginCol = 0
-        for (nRow, nCol) in setOrigin:
-            self.nOriginRow += nRow
-            self.nOriginCol += nCol
-        self.nOriginRow //= len(setOrigin)
-        self.nOriginCol //= len(setOrigin)
+        self.nOriginRow = int(arrRows.sum())//len(arrRows)
+        self.nOriginCol = int(arrCols.sum())//len(arrCols)
+        self.nOriginRow, self.nOriginCol = self.toLattice(self.nOriginRow, self.nOriginCol)
+
+    def locateWells(self):
+        """
+        Alternative to findOrigin(), generateBigWells() and generateSmallWells(). The whole
+        lattice is template matched against the thresholded image (see lattice.py), which
+        places every well at once, so each well is only segmented around its place and one
+        bad well can't throw off the next. The tray rectangle gives the starting scale. A
+        match scoring under fLatticeMinScore, or at either end of the scales searched, is
+        not trusted and raises NoOriginException.
+        
+        In geometry-only mode the match is made on the distorted image, which is close enough
+        for segmentation to find the wells, and the origin and scale are then measured in the
+        lattice frame from the matched origin well and the far corner big well.
+        """
+        nTopRow, nLeftCol, nEndRow = findRectangle(self.arrIntensity)
+        fPhysicalHeight = (self.nBigWellRows-1)*fBigWellSpacing_mm + fBigWellSize_mm
+        fStartScale = (nEndRow-nTopRow)/fPhysicalHeight
+        if fStartScale <= 0: # no tray rectangle
+            raise NoOriginException(self.strImageFile)
+        arrBig_mm, arrSmall_mm = wellLattice(self.nBigWellRows, self.nBigWellCols, self.nSmallWellRows, self.nSmallWellCols)
+        fOriginRow, fOriginCol, fImageScale, fScore = locateLattice(self.arrIntensity > self.nThreshold, fStartScale, arrBig_mm, arrSmall_mm)
+        if fScore < fLatticeMinScore: # nothing like a tray
+            raise NoOriginException(self.strImageFile)
+        if math.isclose(fImageScale, fStartScale*lstLatticeScales[0]) or math.isclose(fImageScale, fStartScale*lstLatticeScales[-1]):
+            raise NoOriginException(self.strImageFile) # the true scale may lie beyond the range searched
+        
+        self.nOriginRow, self.nOriginCol = self.toLattice(int(round(fOriginRow)), int(round(fOriginCol)))
+        fCornerRow, fCornerCol = arrBig_mm[-1]
+        nCornerRow, nCornerCol = self.toLattice(int(round(fOriginRow+fCornerRow*fImageScale)), int(round(fOriginCol+fCornerCol*fImageScale)))
+        self.fScale = math.hypot(nCornerRow-self.nOriginRow, nCornerCol-self.nOriginCol)/math.hypot(fCornerRow, fCornerCol)
+
+        if self.pCallback: self.pCallback() # report progress
+        
+        self.lstBigWells = [self.placeWells(arrBig_mm[nI*self.nBigWellCols:(nI+1)*self.nBigWellCols], fBigWellSize_mm) for nI in range(self.nBigWellRows)]
+        
+        if self.pCallback: self.pCallback() # report progress
+        
+        nStart = 0
+        for nI in range(self.nSmallWellRows):
+            nEnd = nStart+self.nSmallWellCols-(1 if nI == 0 or nI == self.nSmallWellRows-1 else 0) # outer corners are missing
+            self.lstSmallWells.append(self.placeWells(arrSmall_mm[nStart:nEnd], fSmallWellSize_mm))
+            nStart = nEnd
+            
+    def placeWells(self, arrWells_mm, fWellSize_mm):
+        # a row of wells at their lattice positions, each segmented around its place
+        lstWells = []
+        nWellSize_pix = int(fWellSize_mm*self.fScale)
+        for fRow_mm, fCol_mm in arrWells_mm.tolist():
+            if self.pCallback: self.pCallback() # report progress
+            nImageRow, nImageCol = self.toImage(self.nOriginRow+int(round(fRow_mm*self.fScale)), self.nOriginCol+int(round(fCol_mm*self.fScale)))
+            lstWells.append(Well(nImageRow, nImageCol, nWellSize_pix, self.bUV))
+            arrRows, arrCols = findWellPixelsLadder(self.arrIntensity, nImageRow, nImageCol, nWellSize_pix, self.nThreshold, fWellFactorThreshsold, fWellFactorReduction)
+            lstWells[-1].setPixels(arrRows, arrCols, self.arrImage)
+            lstWells[-1].findCentreFromPixels()
+        return lstWells
 
     def regularizeWells(self):
         """
         There are sometimes wells that are out of line due to scatter,
-        weak response, or what-have-you. This finds the median row/column
-        for each line of wells and brings everything in line with it. I tried various
-        techniques for only bringing outliers in, but they suffered from the usual
-        problems of identifying outliers, and given the fixed geometry we are
-        working with it is unlikely that there will be an issue with this approach
+        weak response, or what-have-you. The whole lattice of well centres, big and
+        small, is fitted by least squares with a similarity (scale, rotation and offset)
+        of the known tray layout, dropping outliers from the fit (see lattice.py), and
+        every well is then placed from the fit. The small wells share the scale and
+        rotation but have their own offset, as their position against the big wells
+        is only known roughly. Wells we couldn't properly find don't
+        take part. This also copes with a slightly rotated tray, and gives the scale.
+        A fit whose scale is far from the scale measured so far, or which leaves too
+        many wells off the lattice, is not used and the tray is marked as badly scaled.
+        
+        Alignment only makes sense in the rectilinear frame, so in geometry-only mode the
+        wells are moved into the lattice frame for it and back again before their pixels
+        are regenerated.
         """
 
-        lstColPositions = [[0 for nI in range(len(self.lstBigWells))] for nJ in range(len(self.lstBigWells[0]))] # puts column positions into row-major order
-        for nI, lstRow in enumerate(self.lstBigWells):
-            lstRowPosition = [pWell.nPixelRow for pWell in lstRow if len(pWell.lstPixels) > nWellSizeThreshold] # don't use wells we can't find
-            lstRowPosition.sort() # even size so median is between middle points
-            nMedian = int((lstRowPosition[len(lstRowPosition)//2]+lstRowPosition[len(lstRowPosition)//2-1])/2)            
-            for nJ, pWell in enumerate(lstRow): # bring outliers into alignment
-                pWell.nPixelRow = nMedian
-                lstColPositions[nJ][nI] = pWell.nPixelCol # accumulate column positions
-                
-        for nJ, lstCol in enumerate(lstColPositions): # force all columns into the median position
-            lstCol.sort()
-            nMedian = int((lstCol[len(lstCol)//2]+lstCol[len(lstCol)//2-1])/2)
-            for lstRow in self.lstBigWells:
-                lstRow[nJ].nPixelCol = nMedian
+        self.moveWells(self.toLattice)
+        
+        lstWells = [pWell for lstRow in self.lstBigWells+self.lstSmallWells for pWell in lstRow]
+        arrBig_mm, arrSmall_mm = wellLattice(self.nBigWellRows, self.nBigWellCols, self.nSmallWellRows, self.nSmallWellCols)
+        arrLattice_mm = np.concatenate([arrBig_mm, arrSmall_mm])
+        arrBlocks = np.concatenate([np.zeros(len(arrBig_mm), dtype=int), np.ones(len(arrSmall_mm), dtype=int)]) # small wells get their own offset
+        arrCentres = np.array([(pWell.nPixelRow, pWell.nPixelCol) for pWell in lstWells], dtype=float)
+        arrFound = np.array([len(pWell.arrRows) > nWellSizeThreshold for pWell in lstWells]) # don't use wells we can't find
+        arrModel, arrInliers = fitLattice(arrLattice_mm, arrCentres, arrFound, arrBlocks)
+        if np.count_nonzero(~arrInliers):
+            print("Wells off the lattice:", np.count_nonzero(~arrInliers))
+        fFitScale = math.hypot(arrModel[0], arrModel[1])
+        if abs(fFitScale/self.fScale-1) > fLatticeScaleTolerance or np.count_nonzero(arrInliers) < fLatticeMinInliers*len(lstWells):
+            print("Lattice fit not trusted, scale", fFitScale, "for", self.fScale, "wells on it", np.count_nonzero(arrInliers), "of", len(lstWells))
+            self.bGoodScale = False # keep the measured centres, process() reports the bad scale
+        else:
+            for pWell, (nRow, nCol) in zip(lstWells, np.rint(placeLattice(arrModel, arrLattice_mm, arrBlocks)).astype(int).tolist()):
+                pWell.nPixelRow = nRow
+                pWell.nPixelCol = nCol
+            self.fScale = fFitScale
+
+        # set the positions of the corners for future use
+        self.nRightCol = self.lstBigWells[0][-1].nPixelCol
+        self.nBottomRow = self.lstBigWells[-1][-1].nPixelRow
 
+        self.moveWells(self.toImage)
+        
         # regenerate well pixels if required
         for nI, lstRow in enumerate(self.lstBigWells):
             if self.pCallback: self.pCallback() # report progress
@@ -424,44 +570,10 @@ class QuantiTray:
                     pWell.regeneratePixels(self.arrIntensity, self.arrImage, 0.8*self.nThreshold)
                 if pWell.excessPixels():
                     pWell.regeneratePixels(self.arrIntensity, self.arrImage, 1.2*self.nThreshold)
-                if not len(pWell.lstPixels):
+                if not len(pWell.arrRows):
                     print("NO PIXELS BIG WELL:", nI, nJ)
 
-        # set the positions of the corners for future use
-        self.nRightCol = self.lstBigWells[0][-1].nPixelCol
-        self.nBottomRow = self.lstBigWells[-1][-1].nPixelRow
-
-        if self.bHasSmallWells: # only do this if we have small wells
-            # small wells are complicated by the absence of the outer corner wells
-            # deal with this by analyzing the top and bottom row separately, after handling the central block,
-            # which we do here
-            lstColPositions = [[0 for nI in range(len(self.lstSmallWells[1:-1]))] for nJ in range(len(self.lstSmallWells[1]))] # puts column positions into row-major order
-            for nI, lstRow in enumerate(self.lstSmallWells[1:-1]):
-                lstRowPosition = [pWell.nPixelRow for pWell in lstRow]
-                lstRowPosition.sort() # odd size so median is middle point
-                nMedian = lstRowPosition[len(lstRowPosition)//2]
-                for nJ, pWell in enumerate(lstRow): # bring outliers into alignment
-                    pWell.nPixelRow = nMedian
-                    lstColPositions[nJ][nI] = pWell.nPixelCol # accumulate column positions
-
-            lstColMedian = [] # now use the accumulated column positions to fix the columns
-            for nJ, lstCol in enumerate(lstColPositions): # all but the first column
-                lstCol.sort()
-                nMedian = int((lstCol[len(lstCol)//2]+lstCol[len(lstCol)//2-1])/2)
-                lstColMedian.append(nMedian)
-                for lstRow in self.lstSmallWells[1:-1]:
-                    lstRow[nJ].nPixelCol = nMedian
-
-            # and finally deal with top and bottom row, syncing them with pre-computed column positions
-            # (to which they will be minor contributors) but working out their own row positions
-            for lstRow in [self.lstSmallWells[0], self.lstSmallWells[-1]]:
-                lstRowPosition = [pWell.nPixelRow for pWell in lstRow]
-                lstRowPosition.sort() # even size so median is between middle points
-                nMedian = int((lstRowPosition[len(lstRowPosition)//2]+lstRowPosition[len(lstRowPosition)//2-1])/2)
-                for nJ, pWell in enumerate(lstRow): # bring outliers into alignment
-                    pWell.nPixelRow = nMedian
-                    pWell.nPixelCol = int(lstColMedian[nJ+1])
-
+        if self.bHasSmallWells:
             # regenerate well pixels if required
             for nI, lstRow in enumerate(self.lstSmallWells):
                 if self.pCallback: self.pCallback() # report progress
@@ -470,7 +582,7 @@ class QuantiTray:
                         pWell.regeneratePixels(self.arrIntensity, self.arrImage, 0.8*self.nThreshold)
                     if pWell.excessPixels():
                         pWell.regeneratePixels(self.arrIntensity, self.arrImage, 1.2*self.nThreshold)
-                    if not len(pWell.lstPixels):
+                    if not len(pWell.arrRows):
                         print("NO PIXELS SMALL WELL:", nI, nJ)
 
         if False: # for debugging if we want to see every well position
@@ -495,35 +607,23 @@ class QuantiTray:
             if not os.path.exists(strSubdir):
                 os.mkdir(strSubdir)
                 
+            lstNames = []
             for nWellRow, lstRow in enumerate(self.lstBigWells):
-                for nWellCol, pWell in enumerate(lstRow):
-                    with open(os.path.join(strSubdir, "big_"+str(nWellRow)+"-"+str(nWellCol)+".dat"), "w") as outFile:
-                        for (nRow, nCol) in pWell.lstPixels:
-                            outFile.write(str(self.arrImage[nRow, nCol, 0])+" "+str(self.arrImage[nRow, nCol, 2])+"\n")
-
-            for nWellRow, lstRow in enumerate(self.lstSmallWells):                
-                for nWellCol, pWell in enumerate(lstRow):
-                    with open(os.path.join(strSubdir, "small_"+str(nWellRow)+"-"+str(nWellCol)+".dat"), "w") as outFile:
-                        for (nRow, nCol) in pWell.lstPixels:
-                            outFile.write(str(self.arrImage[nRow, nCol, 0])+" "+str(self.arrImage[nRow, nCol, 2])+"\n")
-                        
-            # overflow well
-            with open(os.path.join(strSubdir, "overflow.dat"), "w") as outFile:
-                for (nRow, nCol) in self.pOverflow.lstPixels:
-                    outFile.write(str(self.arrImage[nRow, nCol, 0])+" "+str(self.arrImage[nRow, nCol, 2])+"\n")
+                lstNames.extend(["big_"+str(nWellRow)+"-"+str(nWellCol)+".dat" for nWellCol in range(len(lstRow))])
+            for nWellRow, lstRow in enumerate(self.lstSmallWells):
+                lstNames.extend(["small_"+str(nWellRow)+"-"+str(nWellCol)+".dat" for nWellCol in range(len(lstRow))])
+            lstNames.append("overflow.dat") # overflow well
+            
+            for strName, pWell in zip(lstNames, [pWell for lstRow in self.lstBigWells+self.lstSmallWells for pWell in lstRow]+[self.pOverflow]):
+                with open(os.path.join(strSubdir, strName), "w") as outFile:
+                    outFile.writelines([str(nR)+" "+str(nB)+"\n" for nR, nG, nB in pWell.arrValues.tolist()])
 
     def classifyWells(self):
         """
         This is called after the initializer to run the classification algorithm on the wells
         """
-        if self.bGood:
-            for lstRow in self.lstBigWells:
-                for pWell in lstRow:
-                    pWell.classify()
-            for lstRow in self.lstSmallWells:
-                for pWell in lstRow:
-                    pWell.classify()
-            self.pOverflow.classify()
+        if self.bGood: # the whole tray in one batch, each well over its own pixels
+            classifyBatch([pWell for lstRow in self.lstBigWells+self.lstSmallWells for pWell in lstRow]+[self.pOverflow])
             
     def getBigWellPositiveCount(self):
         nCount = 0
@@ -543,3 +643,102 @@ class QuantiTray:
                     nCount += 1
         return nCount
 
+
+if __name__ == "__main__":
+    
+    if True: # peak RSS of preprocessing, the old chain of full-image copies against Preprocessor, each in a fresh process
+        import subprocess
+        strScript = """
+import resource, sys
+from quanti_tray import *
+arrDecoded = np.random.default_rng(0).integers(0, 256, (481, 640, nColors), dtype=np.uint8)
+pUnwarper = getUnwarper(fK, 640, 481, nPadding)
+pUnwarper.unwarpImage(arrDecoded) # warm the map
+pStage = Preprocessor()
+nTrays = {"setup": 0, "copies": 1, "one tray": 1, "ten trays": 10}[sys.argv[1]]
+for nI in range(nTrays):
+    arrImage = np.array(arrDecoded) # as decoding from PIL
+    if sys.argv[1] == "copies": # float64 background subtraction and int64 intensity
+        arrUnwarped = pUnwarper.unwarpImage(arrImage)
+        arrDiff = arrUnwarped.astype(float)
+        arrDiff -= arrUnwarped[arrUnwarped.shape[0]//4].astype(float)
+        arrDiff = np.clip(arrDiff, 0, None)
+        arrDiff *= 254/np.max(arrDiff)
+        arrRGB = arrDiff.astype(np.uint8)
+        arrIntensity = np.sum(arrRGB, axis=2)
+        arrHist = np.bincount(arrIntensity.ravel(), minlength=256*3)
+    else:
+        arrRGB, arrIntensity, arrHist, fBackground = pStage.process(arrImage, pUnwarper)
+    del arrImage
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) # kB on Linux
+"""
+        nSetup = 0
+        for strStage in ["setup", "copies", "one tray", "ten trays"]: # a fresh process each, as ru_maxrss never goes down
+            nPeak = int(subprocess.run([sys.executable, "-c", strScript, strStage], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       capture_output=True, text=True, check=True).stdout)
+            nSetup = nSetup or nPeak
+            print("Preprocessing peak RSS,", strStage+":", nPeak, "kB,", nPeak-nSetup, "kB over setup")
+
+    if True: # histogram and threshold search against the original per-pixel loops
+        pRandom = np.random.default_rng(0) # dark background plus bright wells, roughly like a tray
+        arrIntensity = np.clip(np.concatenate([pRandom.normal(40, 30, 300000), pRandom.normal(450, 80, 53600)]), 0, 762).astype(int)
+        arrIntensity = pRandom.permutation(arrIntensity).reshape(520, 680)
+        fStart = time()
+        lstHist = [0 for nI in range(256*3)]
+        for arrRow in arrIntensity:
+            for nValue in arrRow:
+                lstHist[nValue] += 1
+        nMinCount = 1E8
+        nLoopThreshold = 0
+        nSince = 0
+        for nI, nCount in enumerate(lstHist):
+            if nI > nLowerThreshold and nSince < nSinceThreshold:
+                if nCount < nMinCount:
+                    nMinCount = nCount
+                    nLoopThreshold = nI
+                    nSince = 0
+                else:
+                    nSince += 1
+        fLoopTime = time()-fStart
+        fStart = time()
+        for nI in range(100):
+            nThreshold, arrHist = findThreshold(arrIntensity)
+        fTime = (time()-fStart)/100
+        assert nThreshold == nLoopThreshold and list(arrHist) == lstHist
+        print("Threshold", nThreshold, "loops:", fLoopTime, "findThreshold:", fTime)
+
+    if True: # validate geometry-only mode against unwarping the image first
+        # usage: python quanti_tray.py <directory of .tiff images> [qt]
+        # "_uv" in the filename marks a UV image, and trays are assumed to be QT2000 unless "qt" is given
+        strDir = sys.argv[1] if len(sys.argv) > 1 else "."
+        bHasSmallWells = not (len(sys.argv) > 2 and sys.argv[2] == "qt")
+        nFiles = 0
+        nAgree = 0
+        for strFile in sorted(os.listdir(strDir)):
+            if not strFile.endswith(".tiff"):
+                continue
+            strImageFile = os.path.join(strDir, strFile)
+            bUV = "_uv" in strFile
+            mapTrays = {}
+            mapTimes = {}
+            for bGeometry in [False, True]:
+                pTray = QuantiTray(strImageFile, bUV, bHasSmallWells, False, bGeometryOnly=bGeometry)
+                fStart = time()
+                pTray.process()
+                pTray.classifyWells()
+                mapTimes[bGeometry] = time()-fStart
+                mapTrays[bGeometry] = pTray
+            pUnwarped, pGeometry = mapTrays[False], mapTrays[True]
+            lstUnwarped = [pWell for lstRow in pUnwarped.lstBigWells+pUnwarped.lstSmallWells for pWell in lstRow]+[pUnwarped.pOverflow]
+            lstGeometry = [pWell for lstRow in pGeometry.lstBigWells+pGeometry.lstSmallWells for pWell in lstRow]+[pGeometry.pOverflow]
+            nDisagree = sum([pA.bPositive != pB.bPositive for pA, pB in zip(lstUnwarped, lstGeometry)])
+            fMaxShift = 0 # well centres compared in the rectilinear frame
+            for pA, pB in zip(lstUnwarped[:-1], lstGeometry[:-1]):
+                nRow, nCol = pGeometry.latticePosition(pB)
+                fMaxShift = max(fMaxShift, math.hypot(nRow-pA.nPixelRow, nCol-pA.nPixelCol))
+            nFiles += 1
+            if not nDisagree:
+                nAgree += 1
+            print(strFile, "calls differ:", nDisagree, "max centre shift:", fMaxShift, 
+                  "time unwarped/geometry:", mapTimes[False], mapTimes[True])
+        print(nAgree, "of", nFiles, "images with identical calls")
@@ -1,6 +1,5 @@
 import math
 import numpy as np
-from random import random
 
 # PARAMETER
 fFractionalThreshold = 0.20 # fraction of +ve pixels to call +ve well
@@ -12,6 +11,18 @@ fVisOffset = -25.893887788778862
 
 nUVRedCutoff = 150
 
+# simpleClassify() ignores the lines and cuts on a single channel
+nSimpleUVRedThreshold = nUVRedCutoff # UV pixels under this in red are positive
+nSimpleVisBlueThreshold = 70 # visible pixels under this in blue are positive, near getVisLine() mid-scale
+fSimpleThreshold = fFractionalThreshold
+
+# seeds are scattered over the well window by the additive recurrence of the plastic number
+# (the "R2" sequence), which covers a square evenly and is the same on every run
+fSeedPlastic = 1.324717957244746
+fSeedRowStep = 1/fSeedPlastic
+fSeedColStep = 1/fSeedPlastic**2
+nSeedAttempts = 10 # per pixel of well size, only runs out if the window is entirely above nBelowThisRow
+
 # (nRed, nBlue) points ABOVE this line are positive
 def getUVLine(nRed):
     if nRed > nUVRedCutoff:
@@ -20,66 +31,244 @@ def getUVLine(nRed):
         nBlue = nRed*fUVSlope+fUVOffset
     return nBlue
     
-# (nRed, nBlue) points BELOW this line are positive
+# getUVLine() for an array of reds
+def getUVLines(arrRed):
+    return np.where(arrRed > nUVRedCutoff, 256, arrRed*fUVSlope+fUVOffset)
+    
+# (nRed, nBlue) points BELOW this line are positive, works on arrays as well
 def getVisLine(nRed):
     return nRed*fVisSlope+fVisOffset
 
-def findWellPixels(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow = -1):
-    # expect to find first well around the origin, check random pixels
-#    print("T: ", nThreshold)
-    nCount = 0
-    setStart = set()
-    while nCount < nWellSize_pix: # fairly sparse search
-        nCol = nOriginCol + int((0.5-random())*nWellSize_pix)
-        nRow = nOriginRow + int((0.5-random())*nWellSize_pix)
+mapClassifierTables = {} # latest table per mode, with the parameters it was built from
+
+def getClassifierTable(bUV):
+    """
+    Returns a 256x256 boolean table, indexed [red, blue], of the pixels that are positive
+    for UV (above getUVLine) or visible (below getVisLine). Each pixel decision is then one
+    load from the table. The table is keyed on the line parameters as they are now, so
+    changing the calibration builds a new one on next use.
+    """
+    if bUV:
+        tupKey = (fUVSlope, fUVOffset, nUVRedCutoff)
+    else:
+        tupKey = (fVisSlope, fVisOffset)
+    if bUV not in mapClassifierTables or mapClassifierTables[bUV][0] != tupKey:
+        arrRed = np.arange(256)[:, None]
+        arrBlue = np.arange(256)[None, :]
+        if bUV:
+            arrTable = arrBlue > getUVLines(arrRed)
+        else:
+            arrTable = arrBlue < getVisLine(arrRed)
+        mapClassifierTables[bUV] = (tupKey, arrTable) # replaced whole, so a racing reader sees old or new
+    return mapClassifierTables[bUV][1]
+
+def sampleWindow(nOriginRow, nOriginCol, nWellSize_pix, nBelowThisRow = -1):
+    # expect to find first well around the origin, so look at a fixed scatter of pixels
+    # there, which means the same image always gives the same well
+    lstSamples = []
+    for nSample in range(1, nSeedAttempts*nWellSize_pix+1):
+        if len(lstSamples) >= nWellSize_pix: # fairly sparse search
+            break
+        nCol = nOriginCol + int((0.5-(0.5+nSample*fSeedColStep)%1)*nWellSize_pix)
+        nRow = nOriginRow + int((0.5-(0.5+nSample*fSeedRowStep)%1)*nWellSize_pix)
         if nRow < nBelowThisRow:
             continue
-        if arrIntensity[nRow, nCol] > nThreshold:
-            setStart.add((nRow, nCol))
-        nCount += 1
-
-    # now search for connected pixels over threshold, if we found a good pixel
-    setWell = set()
-    lstStart = list(setStart)
-    for nRow, nCol in lstStart:
-        if (nRow, nCol) in setWell:
+        lstSamples.append((nRow, nCol))
+    return lstSamples
+
+def findSeeds(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow = -1):
+    # the sample pixels over threshold
+#    print("T: ", nThreshold)
+    lstSamples = sampleWindow(nOriginRow, nOriginCol, nWellSize_pix, nBelowThisRow)
+    return list(set([(nRow, nCol) for nRow, nCol in lstSamples if arrIntensity[nRow, nCol] > nThreshold]))
+
+def fillWell(arrIntensity, lstSeeds, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow = -1):
+    """
+    Grows the well from its seeds: the seeds themselves plus everything 8-connected to them
+    through pixels over 0.9*nThreshold, keeping off the image border (and, for the overflow,
+    above nBelowThisRow and well left of the origin). Returns (arrRows, arrCols).
+    
+    This is a scanline fill. Acceptable pixels are worked out a row at a time as the fill
+    reaches the row, and are cleared as they are taken, so one boolean mask is both the
+    threshold and the visited set. Each run of pixels is taken in one go and only the run
+    starts in the rows above and below are pushed, so the Python work is per run, not per pixel.
+    """
+    nHeight, nWidth = arrIntensity.shape
+    fThreshold = 0.9*nThreshold
+    nMinRow = 1
+    nMinCol = 1
+    if nBelowThisRow >= 0: # we are working on overflow, stop it running out into the tray area
+        nMinRow = max(nMinRow, nBelowThisRow)
+        nMinCol = max(nMinCol, nOriginCol-nWellSize_pix)
+    arrOpen = np.zeros((nHeight, nWidth), dtype=bool) # columns 0 and nWidth-1 are never open, which ends every run
+    arrRowReady = np.zeros(nHeight, dtype=bool)
+    
+    def getRow(nRow): # open pixels of a row, None outside the rows we can fill
+        if nRow < nMinRow or nRow > nHeight-2:
+            return None
+        if not arrRowReady[nRow]:
+            arrOpen[nRow, nMinCol:nWidth-1] = arrIntensity[nRow, nMinCol:nWidth-1] > fThreshold
+            arrRowReady[nRow] = True
+        return arrOpen[nRow]
+
+    # seeds are always in the well and the search spreads to their neighbours. A seed that
+    # could be filled anyway is just filled from, the others are kept as they are
+    lstStack = []
+    lstKept = []
+    for nRow, nCol in lstSeeds:
+        if nRow >= 0 and nRow < nHeight and nCol >= 0 and nCol < nWidth:
+            arrRow = getRow(nRow)
+            if arrRow is not None and arrRow[nCol]:
+                lstStack.append((nRow, nCol))
+                continue
+            lstStack.extend([(nRow-1, nCol-1), (nRow-1, nCol), (nRow-1, nCol+1),
+                            (nRow, nCol-1),                     (nRow, nCol+1),
+                            (nRow+1, nCol-1), (nRow+1, nCol), (nRow+1, nCol+1)])
+        lstKept.append((nRow, nCol))
+
+    lstSpans = []
+    while len(lstStack):
+        nRow, nCol = lstStack.pop()
+        arrRow = getRow(nRow)
+        if arrRow is None or nCol < 0 or nCol >= nWidth or not arrRow[nCol]:
             continue
-        setWell.add((nRow, nCol))
-        setCandidates = set([(nRow-1, nCol-1), (nRow-1, nCol), (nRow-1, nCol+1),
-                                    (nRow, nCol-1),                     (nRow, nCol+1),
-                                    (nRow+1, nCol-1), (nRow+1, nCol), (nRow+1, nCol+1)])
-        while len(setCandidates): # tail-recursive loop
-            nRow, nCol = setCandidates.pop()
-            if nBelowThisRow >= 0:
-                # we are working on overflow, which can exceed image size
-                if nRow < nBelowThisRow:
-                    continue
+        nLeft = nCol-int(arrRow[nCol::-1].argmin())+1 # the run through this pixel
+        nRight = nCol+int(arrRow[nCol:].argmin())-1
+        arrRow[nLeft:nRight+1] = False
+        lstSpans.append((nRow, nLeft, nRight))
+        nStart = max(nLeft-1, 0) # diagonal neighbours count, so look one further each side
+        for nNextRow in (nRow-1, nRow+1):
+            arrNext = getRow(nNextRow)
+            if arrNext is None:
+                continue
+            arrSegment = arrNext[nStart:nRight+2]
+            arrRunStarts = (arrSegment[1:] & ~arrSegment[:-1]).nonzero()[0]+1
+            if arrSegment[0]:
+                lstStack.append((nNextRow, nStart))
+            lstStack.extend([(nNextRow, nStart+nI) for nI in arrRunStarts.tolist()])
 
-                # stop overflow from running out into the tray area, which can happen
-                if nCol < nOriginCol-nWellSize_pix or nCol >= arrIntensity.shape[1]:
-                    continue
-                if nRow < 0 or nRow >= arrIntensity.shape[0]:
-                    continue
-                    
-            if (nRow, nCol) not in setWell:
-                if nRow-1 < 0 or nRow+1 >= arrIntensity.shape[0]:
-                    continue
-                if nCol-1 < 0 or nCol+1 >= arrIntensity.shape[1]:
-                    continue
-                if arrIntensity[nRow, nCol] > 0.9*nThreshold:
-                    setWell.add((nRow, nCol))
-                    setCandidates.update([(nRow-1, nCol-1), (nRow-1, nCol), (nRow-1, nCol+1),
-                                        (nRow, nCol-1),                     (nRow, nCol+1),
-                                        (nRow+1, nCol-1), (nRow+1, nCol), (nRow+1, nCol+1)])
+    arrSpans = np.array(lstSpans, dtype=int).reshape([-1, 3])
+    arrLengths = arrSpans[:, 2]-arrSpans[:, 1]+1
+    arrRows = np.repeat(arrSpans[:, 0], arrLengths)
+    arrCols = np.arange(len(arrRows))-np.repeat(np.cumsum(arrLengths)-arrLengths-arrSpans[:, 1], arrLengths)
+    arrSeeds = np.array(lstKept, dtype=int).reshape([-1, 2])
+    return np.concatenate([arrSeeds[:, 0], arrRows]), np.concatenate([arrSeeds[:, 1], arrCols])
+
+def findWellPixels(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow = -1):
+    # seed around the origin and grow the well, returned as arrays of rows and columns
+    lstSeeds = findSeeds(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow)
+    return fillWell(arrIntensity, lstSeeds, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow)
+
+def findWellPixelsLadder(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, nThreshold, fMinFactor, fReduction):
+    """
+    Deals with bad contrast, giving the same pixels as calling findWellPixels with the
+    threshold multiplied down by fReduction (1, fReduction, fReduction**2...) until it finds
+    something or the factor is no longer above fMinFactor, but with a single fill.
     
-    return setWell
+    The sample pixels don't depend on the threshold and a fill is empty only when it has no
+    seeds, so the first threshold on the ladder that finds anything is the first one below
+    the brightest sample. Dim wells then cost the same as bright ones.
+    """
+    lstSamples = sampleWindow(nOriginRow, nOriginCol, nWellSize_pix)
+    if not len(lstSamples):
+        return noPixels()
+    nBrightest = max([arrIntensity[nRow, nCol] for nRow, nCol in lstSamples])
+    fFactor = 1.0
+    while fFactor > fMinFactor: # the same ladder of factors, multiplied out the same way
+        if nBrightest > fFactor*nThreshold:
+            return findWellPixels(arrIntensity, nOriginRow, nOriginCol, nWellSize_pix, fFactor*nThreshold)
+        fFactor *= fReduction
+    return noPixels()
+
+def noPixels():
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+def classifyPixels(bUV, arrValues, arrSegments, arrCentres, arrRows=None, arrCols=None):
+    """
+    The decisions behind Well.classify() for the pixels of many wells at once. Pixel nI
+    belongs to well arrSegments[nI], whose centre is row arrCentres[nSegment, 0], column
+    arrCentres[nSegment, 1]; pixel positions are only needed for the UV radial weights.
+    Returns the per-pixel flags and each well's positive fraction, with the per-well sums
+    reduced by np.bincount.
+    """
+    nSegments = len(arrCentres)
+    arrRed = arrValues[:, 0]
+    arrLine = getClassifierTable(bUV).take((arrRed.astype(np.intp) << 8) | arrValues[:, 2])
+    if bUV:
+        arrCounts = np.bincount(arrSegments[arrRed < nUVRedCutoff], minlength=nSegments)
+        arrRowOffsets = arrRows-arrCentres[arrSegments, 0]
+        arrColOffsets = arrCols-arrCentres[arrSegments, 1]
+        arrPositive = np.where(arrLine, np.sqrt(arrRowOffsets**2+arrColOffsets**2).astype(int), 0)
+    else:
+        arrCounts = np.bincount(arrSegments, minlength=nSegments)
+        arrPositive = arrLine.astype(int)
+    # sums of ints are exact in float64, so the fractions match classify()
+    return arrPositive, np.bincount(arrSegments, weights=arrPositive, minlength=nSegments)/(arrCounts+1)
+
+def wellCentres(lstWells):
+    return np.array([(pWell.nPixelRow, pWell.nPixelCol) for pWell in lstWells], dtype=int).reshape([-1, 2])
+
+def classifyBatch(lstWells):
+    """
+    Well.classify() for a whole tray in one pass. Every well's pixels are concatenated
+    with a segment id per pixel and decided together. The per-pixel flags and bPositive
+    are written back to each well exactly as classify() would leave them.
+    """
+    for bUV in set([pWell.bUV for pWell in lstWells]): # a tray has one mode, but don't rely on it
+        lstBatch = [pWell for pWell in lstWells if pWell.bUV == bUV]
+        arrLengths = np.array([len(pWell.arrRows) for pWell in lstBatch], dtype=int)
+        arrSegments = np.repeat(np.arange(len(lstBatch)), arrLengths)
+        arrValues = np.concatenate([pWell.arrValues for pWell in lstBatch])
+        if bUV:
+            arrPositive, arrFractions = classifyPixels(bUV, arrValues, arrSegments, wellCentres(lstBatch),
+                                                       np.concatenate([pWell.arrRows for pWell in lstBatch]),
+                                                       np.concatenate([pWell.arrCols for pWell in lstBatch]))
+        else:
+            arrPositive, arrFractions = classifyPixels(bUV, arrValues, arrSegments, wellCentres(lstBatch))
+        for pWell, arrWellPositive, fFraction in zip(lstBatch, np.split(arrPositive, np.cumsum(arrLengths)[:-1]), arrFractions.tolist()):
+            pWell.arrPositive = arrWellPositive
+            pWell.bPositive = fFraction > fFractionalThreshold
+
+def labelImage(lstWells, tupShape):
+    """
+    Returns an int16 image of tupShape holding, for each pixel, one plus the index in lstWells
+    of the well it belongs to, or 0 if it is in no well. A pixel two wells both claim goes
+    to the later one, so this is for drawing the wells; each well keeps its own pixels in
+    arrRows and arrCols for classification and output.
+    """
+    arrLabels = np.zeros(tupShape, dtype=np.int16)
+    arrLengths = [len(pWell.arrRows) for pWell in lstWells]
+    if sum(arrLengths):
+        arrLabels[np.concatenate([pWell.arrRows for pWell in lstWells]),
+                  np.concatenate([pWell.arrCols for pWell in lstWells])] = np.repeat(np.arange(1, len(lstWells)+1), arrLengths)
+    return arrLabels
+
+def flagImage(lstWells, tupShape):
+    """
+    Returns an int16 image of tupShape holding the per-pixel flags classify() left in each
+    well's arrPositive (the radial weight for UV, 1 for visible) and 0 elsewhere. A pixel
+    is flagged if any well that claims it flagged it.
+    """
+    arrFlags = np.zeros(tupShape, dtype=np.int16)
+    lstFlagged = [pWell.arrPositive > 0 for pWell in lstWells]
+    if sum([np.count_nonzero(arrFlagged) for arrFlagged in lstFlagged]):
+        arrFlags[np.concatenate([pWell.arrRows[arrFlagged] for pWell, arrFlagged in zip(lstWells, lstFlagged)]),
+                 np.concatenate([pWell.arrCols[arrFlagged] for pWell, arrFlagged in zip(lstWells, lstFlagged)])] = \
+            np.concatenate([pWell.arrPositive[arrFlagged] for pWell, arrFlagged in zip(lstWells, lstFlagged)])
+    return arrFlags
 
 class Well:
     """
     A well represents a single dimple in the Idexx tray. It has a size in pixels and
     and position in pixels at creation. After processing it has computed image 
     coordinates and an array of pixel values associated with it.
+
+    Pixels are held as arrays rather than lists of tuples, as a tray has thousands
+    of them per well: arrRows[nI], arrCols[nI] is the pixel whose RGB is arrValues[nI].
     """
+    __slots__ = ["nSize", "bUV", "nRow", "nCol", "arrRows", "arrCols", "arrValues", "arrPositive",
+                 "nPixelRow", "nPixelCol", "bPositive"]
+
     def __init__(self, nRow, nCol, nSize, bUV):
         self.nSize = nSize
         self.bUV = bUV
@@ -87,9 +276,9 @@ class Well:
         self.nRow = nRow # pixel co-ordinates based on approximate geometry
         self.nCol = nCol
         
-        self.lstPixels = [] # (nRow, nCol) values from image array
-        self.lstValues = [] # RGB values from image array
-        self.lstPositive = [] # > 0 for positive, 0 for negative
+        self.arrRows, self.arrCols = noPixels() # pixel co-ordinates in the image array
+        self.arrValues = np.zeros([0, 3], dtype=np.uint8) # RGB values from image array
+        self.arrPositive = np.zeros(0, dtype=int) # > 0 for positive, 0 for negative
         
         self.nPixelRow = -1 # pixel co-ordinates based on values
         self.nPixelCol = -1
@@ -98,82 +287,270 @@ class Well:
 
     def fewPixels(self):
         # return true if have less than half the expected pixels flagged
-        return len(self.lstPixels) < (self.nSize**2)/2
+        return len(self.arrRows) < (self.nSize**2)/2
 
     def excessPixels(self):
         # return true if have more than half the expected pixels flagged
-        return len(self.lstPixels) > self.nSize**2
+        return len(self.arrRows) > self.nSize**2
 
-    def setPixels(self, lstPixels):
-        self.lstPixels = lstPixels
-
-    def setValues(self, lstValues):
-        self.lstValues = lstValues
+    def setPixels(self, arrRows, arrCols, arrImage):
+        # gather the values in one go
+        self.arrRows = arrRows
+        self.arrCols = arrCols
+        self.arrValues = arrImage[arrRows, arrCols]
         
     def regeneratePixels(self, arrIntensity, arrImage, nThreshold):
-        fFactor = 1.0
-        setWellPixels = set()
-        while not len(setWellPixels) and fFactor > 0.8:
-            setWellPixels = findWellPixels(arrIntensity, self.nPixelRow, self.nPixelCol, self.nSize, fFactor*nThreshold)
-            fFactor *= 0.99
-        self.lstPixels = []
-        self.lstValues = []
-        for (nPixelRow, nPixelCol) in setWellPixels:
-            self.lstPixels.append((nPixelRow, nPixelCol))
-            self.lstValues.append(arrImage[nPixelRow, nPixelCol])
+        arrRows, arrCols = findWellPixelsLadder(arrIntensity, self.nPixelRow, self.nPixelCol, self.nSize, nThreshold, 0.8, 0.99)
+        self.setPixels(arrRows, arrCols, arrImage)
         
     def findCentreFromPixels(self):
         # unweighted mean
-        if len(self.lstPixels):
-            self.nPixelRow = sum([nRow for nRow, nCol in self.lstPixels])//len(self.lstPixels)
-            self.nPixelCol = sum([nCol for nRow, nCol in self.lstPixels])//len(self.lstPixels)
+        if len(self.arrRows):
+            self.nPixelRow = int(self.arrRows.sum())//len(self.arrRows)
+            self.nPixelCol = int(self.arrCols.sum())//len(self.arrCols)
         else:
             print("NO PIXELS in findCentreFromPixels AT: ", self.nRow, self.nCol)
             self.nPixelRow = self.nRow
             self.nPixelCol = self.nCol
             
     def classify(self):
-        # Determine if the well is positive in the visible or UV
-        self.lstPositive = []
-        nCount = 0
-        for nI, (nR, nG, nB) in enumerate(self.lstValues):
-            if self.bUV:
-                if nR < nUVRedCutoff: # only count under cutoff in red for UV due to saturation
-                    nCount += 1
-                if nB > getUVLine(nR): # in the UV outer pixels tend to turn first and most clearly, so enhance!
-                    nDist = int(math.sqrt((self.lstPixels[nI][0]-self.nPixelRow)**2+(self.lstPixels[nI][1]-self.nPixelCol)**2))
-                    self.lstPositive.append(nDist)
-                else:
-                    self.lstPositive.append(0)
-            else:
-                nCount += 1
-                if nB < getVisLine(nR):
-                    self.lstPositive.append(1) # radial correction not needed here (yet)
-                else:
-                    self.lstPositive.append(0)
+        # Determine if the well is positive in the visible or UV, over all the pixels at once
+        arrRed = self.arrValues[:, 0]
+        arrLine = getClassifierTable(self.bUV).take((arrRed.astype(np.intp) << 8) | self.arrValues[:, 2]) # flat [red, blue]
+        if self.bUV:
+            nCount = np.count_nonzero(arrRed < nUVRedCutoff) # only count under cutoff in red for UV due to saturation
+            # in the UV outer pixels tend to turn first and most clearly, so enhance!
+            arrDist = np.sqrt((self.arrRows-self.nPixelRow)**2+(self.arrCols-self.nPixelCol)**2).astype(int)
+            self.arrPositive = np.where(arrLine, arrDist, 0)
+        else:
+            nCount = len(arrRed)
+            self.arrPositive = arrLine.astype(int) # radial correction not needed here (yet)
                     
         self.bPositive = False
-        if sum(self.lstPositive)/(nCount+1) > fFractionalThreshold:
+        if int(self.arrPositive.sum())/(nCount+1) > fFractionalThreshold:
             self.bPositive = True
 
     def simpleClassify(self):
-        # Determine if the well is positive in the visible or UV
-        self.lstPositive = []
-        nCount = 0
-        for nI, (nR, nG, nB) in enumerate(self.lstValues):
-            if self.bUV:
-                if nR < nSimpleUVRedThreshold: # only count under cutoff in red for UV due to saturation
-                    nCount += 1
-                    self.lstPositive.append(1)
-                else:
-                    self.lstPositive.append(0)
-            else: # visible
-                nCount += 1
-                if nB < nSimpleVisBlueThreshold:
-                    self.lstPositive.append(1) # radial correction not needed here (yet)
-                else:
-                    self.lstPositive.append(0)
+        # Determine if the well is positive in the visible or UV, over all the pixels at once
+        if self.bUV:
+            self.arrPositive = (self.arrValues[:, 0] < nSimpleUVRedThreshold).astype(int)
+            nCount = int(self.arrPositive.sum()) # only count under cutoff in red for UV due to saturation
+        else: # visible
+            self.arrPositive = (self.arrValues[:, 2] < nSimpleVisBlueThreshold).astype(int)
+            nCount = len(self.arrPositive)
                     
         self.bPositive = False
-        if sum(self.lstPositive)/(nCount+1) > fSimpleThreshold:
+        if int(self.arrPositive.sum())/(nCount+1) > fSimpleThreshold:
             self.bPositive = True
+
+if __name__ == "__main__":
+    from time import time
+    
+    if True: # scanline fill against the original set flood fill, per well size
+        def fillWellLoop(arrIntensity, lstSeeds, nOriginCol, nWellSize_pix, nThreshold, nBelowThisRow = -1):
+            # the original set-based flood fill, a pixel at a time
+            setWell = set()
+            lstStart = list(lstSeeds)
+            for nRow, nCol in lstStart:
+                if (nRow, nCol) in setWell:
+                    continue
+                setWell.add((nRow, nCol))
+                setCandidates = set([(nRow-1, nCol-1), (nRow-1, nCol), (nRow-1, nCol+1),
+                                            (nRow, nCol-1),                     (nRow, nCol+1),
+                                            (nRow+1, nCol-1), (nRow+1, nCol), (nRow+1, nCol+1)])
+                while len(setCandidates): # tail-recursive loop
+                    nRow, nCol = setCandidates.pop()
+                    if nBelowThisRow >= 0:
+                        # we are working on overflow, which can exceed image size
+                        if nRow < nBelowThisRow:
+                            continue
+
+                        # stop overflow from running out into the tray area, which can happen
+                        if nCol < nOriginCol-nWellSize_pix or nCol >= arrIntensity.shape[1]:
+                            continue
+                        if nRow < 0 or nRow >= arrIntensity.shape[0]:
+                            continue
+
+                    if (nRow, nCol) not in setWell:
+                        if nRow-1 < 0 or nRow+1 >= arrIntensity.shape[0]:
+                            continue
+                        if nCol-1 < 0 or nCol+1 >= arrIntensity.shape[1]:
+                            continue
+                        if arrIntensity[nRow, nCol] > 0.9*nThreshold:
+                            setWell.add((nRow, nCol))
+                            setCandidates.update([(nRow-1, nCol-1), (nRow-1, nCol), (nRow-1, nCol+1),
+                                                (nRow, nCol-1),                     (nRow, nCol+1),
+                                                (nRow+1, nCol-1), (nRow+1, nCol), (nRow+1, nCol+1)])
+
+            return setWell
+
+        pRandom = np.random.default_rng(0)
+        for strWell, nHeight, nWidth in [("small", 12, 12), ("big", 27, 27), ("overflow", 30, 120)]:
+            arrIntensity = pRandom.integers(0, 100, (200, 300)).astype(np.uint16) # background
+            arrRow, arrCol = np.ogrid[:200, :300]
+            if strWell == "overflow": # a block rather than a disk
+                arrInside = (np.abs(arrRow-100) <= nHeight//2) & (np.abs(arrCol-150) <= nWidth//2)
+            else:
+                arrInside = (arrRow-100)**2+(arrCol-150)**2 <= (nWidth/2)**2
+            arrIntensity[arrInside] += 400
+            lstSeeds = findSeeds(arrIntensity, 100, 150, min(nHeight, nWidth), 300)
+            nRepeats = 50
+            fStart = time()
+            for nI in range(nRepeats):
+                setLoop = fillWellLoop(arrIntensity, lstSeeds, 150, nWidth, 300)
+            fLoopTime = (time()-fStart)/nRepeats
+            fStart = time()
+            for nI in range(nRepeats):
+                arrRows, arrCols = fillWell(arrIntensity, lstSeeds, 150, nWidth, 300)
+            fTime = (time()-fStart)/nRepeats
+            assert set(zip(arrRows.tolist(), arrCols.tolist())) == setLoop and len(arrRows) == len(setLoop)
+            print(strWell, len(setLoop), "pixels, set fill:", fLoopTime, "scanline fill:", fTime)
+
+    if True: # one pass down the threshold ladder against retrying the fill, for a bright and a dim well
+        arrIntensity = pRandom.integers(0, 100, (200, 300)).astype(np.uint16)
+        arrRow, arrCol = np.ogrid[:200, :300]
+        arrInside = (arrRow-100)**2+(arrCol-150)**2 <= 13**2
+        for strWell, nBrightness in [("bright", 400), ("dim", 165)]: # the dim well only shows well down the ladder
+            arrWell = arrIntensity.copy()
+            arrWell[arrInside] += nBrightness
+            nRepeats = 50
+            fStart = time()
+            for nI in range(nRepeats):
+                nFills = 0
+                arrRetryRows, arrRetryCols = noPixels()
+                fFactor = 1.0
+                while not len(arrRetryRows) and fFactor > 0.8:
+                    arrRetryRows, arrRetryCols = findWellPixels(arrWell, 100, 150, 27, fFactor*300)
+                    fFactor *= 0.99
+                    nFills += 1
+            fRetryTime = (time()-fStart)/nRepeats
+            fStart = time()
+            for nI in range(nRepeats):
+                arrRows, arrCols = findWellPixelsLadder(arrWell, 100, 150, 27, 300, 0.8, 0.99)
+            fTime = (time()-fStart)/nRepeats
+            assert np.array_equal(arrRows, arrRetryRows) and np.array_equal(arrCols, arrRetryCols)
+            print(strWell, "well,", nFills, "fills retrying:", fRetryTime, "ladder:", fTime)
+
+    if True: # vectorized classification against the per-pixel loops, over every (red, blue) pair
+        def classifyLoop(pWell):
+            # the original classify(), a pixel at a time
+            lstPositive = []
+            nCount = 0
+            for nI, (nR, nG, nB) in enumerate(pWell.arrValues.tolist()):
+                if pWell.bUV:
+                    if nR < nUVRedCutoff: # only count under cutoff in red for UV due to saturation
+                        nCount += 1
+                    if nB > getUVLine(nR): # in the UV outer pixels tend to turn first and most clearly, so enhance!
+                        nDist = int(math.sqrt((int(pWell.arrRows[nI])-pWell.nPixelRow)**2+(int(pWell.arrCols[nI])-pWell.nPixelCol)**2))
+                        lstPositive.append(nDist)
+                    else:
+                        lstPositive.append(0)
+                else:
+                    nCount += 1
+                    if nB < getVisLine(nR):
+                        lstPositive.append(1) # radial correction not needed here (yet)
+                    else:
+                        lstPositive.append(0)
+
+            pWell.arrPositive = np.array(lstPositive, dtype=int)
+            pWell.bPositive = False
+            if sum(lstPositive)/(nCount+1) > fFractionalThreshold:
+                pWell.bPositive = True
+
+        def simpleClassifyLoop(pWell):
+            # the original simpleClassify(), a pixel at a time
+            lstPositive = []
+            nCount = 0
+            for nI, (nR, nG, nB) in enumerate(pWell.arrValues.tolist()):
+                if pWell.bUV:
+                    if nR < nSimpleUVRedThreshold: # only count under cutoff in red for UV due to saturation
+                        nCount += 1
+                        lstPositive.append(1)
+                    else:
+                        lstPositive.append(0)
+                else: # visible
+                    nCount += 1
+                    if nB < nSimpleVisBlueThreshold:
+                        lstPositive.append(1) # radial correction not needed here (yet)
+                    else:
+                        lstPositive.append(0)
+
+            pWell.arrPositive = np.array(lstPositive, dtype=int)
+            pWell.bPositive = False
+            if sum(lstPositive)/(nCount+1) > fSimpleThreshold:
+                pWell.bPositive = True
+
+        arrImage = np.zeros([256, 256, 3], dtype=np.uint8)
+        arrImage[:, :, 0] = np.arange(256)[:, None] # red down the rows
+        arrImage[:, :, 1] = pRandom.integers(0, 256, (256, 256))
+        arrImage[:, :, 2] = np.arange(256)[None, :] # blue along the columns
+        arrRows, arrCols = np.indices([256, 256]).reshape([2, -1])
+        for bUV in (True, False):
+            pWell = Well(128, 128, 256, bUV)
+            pWell.setPixels(arrRows, arrCols, arrImage)
+            pWell.findCentreFromPixels()
+            for strMethod, pLoop in [("classify", classifyLoop), ("simpleClassify", simpleClassifyLoop)]:
+                nRepeats = 10
+                fStart = time()
+                for nI in range(nRepeats):
+                    pLoop(pWell)
+                fLoopTime = (time()-fStart)/nRepeats
+                arrLoop, bLoop = pWell.arrPositive, pWell.bPositive
+                fStart = time()
+                for nI in range(nRepeats):
+                    getattr(pWell, strMethod)()
+                fTime = (time()-fStart)/nRepeats
+                assert np.array_equal(pWell.arrPositive, arrLoop) and pWell.bPositive == bLoop
+                print("UV" if bUV else "visible", strMethod, len(arrRows), "pixels, loop:", fLoopTime, "vectorized:", fTime)
+
+        # the tables follow the calibration
+        fUVSlope, fVisOffset = fUVSlope*1.1, fVisOffset+5
+        for bUV in (True, False):
+            pWell = Well(128, 128, 256, bUV)
+            pWell.setPixels(arrRows, arrCols, arrImage)
+            pWell.findCentreFromPixels()
+            classifyLoop(pWell)
+            arrLoop = pWell.arrPositive
+            pWell.classify()
+            assert np.array_equal(pWell.arrPositive, arrLoop)
+        print("classifier tables rebuilt for new line parameters")
+
+    if True: # one batched pass over a tray's worth of wells against classifying them one at a time
+        for bUV in (True, False):
+            arrImage = pRandom.integers(0, 256, (300, 300, 3)).astype(np.uint8)
+            lstWells = []
+            for nI in range(97):
+                nSize = 27 if nI < 49 else 12
+                arrRows, arrCols = np.indices([nSize, nSize]).reshape([2, -1])+[[nI//10*30], [nI%10*30]] # laid out without overlaps
+                arrImage[arrRows, arrCols, 0] //= 1+nI%4 # spread the calls
+                lstWells.append(Well(0, 0, nSize, bUV))
+                lstWells[-1].setPixels(arrRows, arrCols, arrImage)
+                lstWells[-1].findCentreFromPixels()
+            for nI in range(3): # and some that overlap, one of them entirely
+                arrRows, arrCols = np.indices([20+nI*5, 30]).reshape([2, -1])+[[nI*10], [15]]
+                lstWells.append(Well(0, 0, 30, bUV))
+                lstWells[-1].setPixels(arrRows, arrCols, arrImage)
+                lstWells[-1].findCentreFromPixels()
+            lstWells.append(Well(0, 0, 0, bUV)) # an overflow that wasn't found
+            nRepeats = 20
+            fStart = time()
+            for nI in range(nRepeats):
+                for pWell in lstWells:
+                    pWell.classify()
+            fWellTime = (time()-fStart)/nRepeats
+            lstExpected = [(pWell.arrPositive, pWell.bPositive) for pWell in lstWells]
+            fStart = time()
+            for nI in range(nRepeats):
+                classifyBatch(lstWells)
+            fTime = (time()-fStart)/nRepeats
+            for pWell, (arrPositive, bPositive) in zip(lstWells, lstExpected):
+                assert np.array_equal(pWell.arrPositive, arrPositive) and pWell.bPositive == bPositive
+            arrClaimed = np.zeros(arrImage.shape[:2], dtype=bool) # drawn pixels are every well's, flagged if any well flags them
+            arrFlagged = np.zeros(arrImage.shape[:2], dtype=bool)
+            for pWell in lstWells:
+                arrClaimed[pWell.arrRows, pWell.arrCols] = True
+                arrFlagged[pWell.arrRows[pWell.arrPositive > 0], pWell.arrCols[pWell.arrPositive > 0]] = True
+            assert np.array_equal(labelImage(lstWells, arrImage.shape[:2]) > 0, arrClaimed)
+            assert np.array_equal(flagImage(lstWells, arrImage.shape[:2]) > 0, arrFlagged)
+            print("UV" if bUV else "visible", "tray,", sum([pWell.bPositive for pWell in lstWells]), "positive, per well:", fWellTime,
+                  "batched:", fTime)